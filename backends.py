@@ -0,0 +1,727 @@
+import copy
+import gc
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+import urllib.error
+import urllib.request
+
+from scheduler import RequestScheduler, RetryableError
+
+logger = logging.getLogger(__name__)
+
+INPUT_PROMPT = "Text: {input}"
+INPUT_MARKER = "\uffff"
+
+
+def build_prompt(context_prompt, input_text, label_type):
+    prompt = [INPUT_PROMPT.format(input=input_text), f"{label_type}:"]
+    prompt = "\n".join(prompt)
+    if context_prompt:
+        prompt = f"{context_prompt}\n\n{prompt}"
+    return prompt
+
+
+def parse_prediction(output, model_labels):
+    # Maps a free-form answer to a label; unknown answers are kept as they are
+    output = output.strip()
+    labels = {l.lower(): l for l in model_labels}
+    label = labels.get(output.rstrip(".").strip().lower())
+
+    if label is None:
+        positions = {l: output.lower().find(l.lower()) for l in model_labels}
+        positions = {l: p for l, p in positions.items() if p >= 0}
+        if positions:
+            label = min(positions, key=positions.get)
+            logger.warning(f'Fixing prediction: "{output}" => "{label}"')
+        else:
+            logger.warning(f'Prediction "{output}" is not in labels: {model_labels}.')
+            return output
+
+    if isinstance(model_labels, dict):
+        label = model_labels[label]
+    return label
+
+
+def build_label_trie(tokenizer, labels):
+    # Token trie over the label strings, with and without a leading space since
+    # labels usually follow the prompt separator. Terminal nodes map None to
+    # the label they complete.
+    trie = {}
+    for label in labels:
+        for text in [label, f" {label}"]:
+            node = trie
+            for token_id in tokenizer(text, add_special_tokens=False)["input_ids"]:
+                node = node.setdefault(token_id, {})
+            node[None] = label
+    return trie
+
+
+def get_allowed_tokens(trie, generated, eos_token_id):
+    node = trie
+    for token_id in generated:
+        node = node.get(token_id)
+        if node is None:
+            return [eos_token_id]
+    allowed = [token_id for token_id in node if token_id is not None]
+    if None in node:
+        allowed.append(eos_token_id)
+    return allowed
+
+
+def get_trie_depth(trie):
+    children = [node for token_id, node in trie.items() if token_id is not None]
+    return 1 + max([get_trie_depth(node) for node in children], default=0)
+
+
+def get_scored_prediction(label_scores, model_labels):
+    label = max(label_scores, key=label_scores.get)
+    if isinstance(model_labels, dict):
+        label = model_labels[label]
+    return label
+
+
+def parse_output(output, model_labels):
+    if output is None:
+        # failed request (with ignore_errors)
+        return ""
+    if isinstance(output, dict):
+        return get_scored_prediction(output, model_labels)
+    return parse_prediction(output, model_labels)
+
+
+class HFClassifier:
+    def __init__(
+        self,
+        model_name,
+        checkpoint_path=None,
+        dtype=None,
+        device=None,
+        max_new_tokens=256,
+        constrained_decoding=False,
+        label_scoring=False,
+        prefix_cache=False,
+        prefix_cache_size=4,
+        verify_prefix_cache=True,
+        prefix_cache_atol=1e-3,
+        **kwargs,
+    ):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.model_name = model_name
+        self.max_new_tokens = max_new_tokens
+        self.constrained_decoding = constrained_decoding
+        self.label_scoring = label_scoring
+        self._label_tries = {}
+        self.prefix_cache = prefix_cache
+        self.prefix_cache_size = prefix_cache_size
+        self.verify_prefix_cache = verify_prefix_cache
+        self.prefix_cache_atol = prefix_cache_atol
+        self._prefix_caches = {}
+        model_path = checkpoint_path or model_name
+        self.model_path = model_path
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+
+        logger.info(f"Loading tokenizer {model_path}...")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        logger.info(f"Loading model {model_path}...")
+        self.model = AutoModelForCausalLM.from_pretrained(model_path, torch_dtype=dtype)
+        self.model.to(device)
+        self.model.eval()
+        self.dtype = self.model.dtype
+
+    def build_prompt(self, item):
+        prompt = build_prompt(item["context_prompt"], item["input"], item["label_type"])
+        if self.tokenizer.chat_template:
+            prompt = self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt}],
+                tokenize=False,
+                add_generation_prompt=True,
+            )
+        return prompt
+
+    def split_prompt(self, item):
+        # Splits the formatted prompt into the part shared by all samples of a
+        # label permutation (guidelines + task prompt) and the sample suffix
+        prompt = self.build_prompt(item)
+        marker_prompt = self.build_prompt(dict(item, input=INPUT_MARKER))
+        split_idx = marker_prompt.find(INPUT_PROMPT.format(input=INPUT_MARKER))
+        if split_idx <= 0 or prompt[:split_idx] != marker_prompt[:split_idx]:
+            return "", prompt
+        return prompt[:split_idx], prompt[split_idx:]
+
+    def count_tokens(self, prompts):
+        input_ids = self.tokenizer(prompts, add_special_tokens=False)["input_ids"]
+        return [len(x) for x in input_ids]
+
+    def get_label_trie(self, labels):
+        labels = tuple(labels)
+        if labels not in self._label_tries:
+            self._label_tries[labels] = build_label_trie(self.tokenizer, labels)
+        return self._label_tries[labels]
+
+    def generate(self, prompts, tries=None):
+        import torch
+
+        inputs = self.tokenizer(
+            prompts, return_tensors="pt", padding=True, add_special_tokens=False
+        ).to(self.device)
+        generation_kwargs = dict(max_new_tokens=self.max_new_tokens)
+        if tries:
+            prompt_length = inputs["input_ids"].shape[1]
+            eos_token_id = self.tokenizer.eos_token_id
+            generation_kwargs["prefix_allowed_tokens_fn"] = (
+                lambda batch_id, input_ids: get_allowed_tokens(
+                    tries[batch_id], input_ids[prompt_length:].tolist(), eos_token_id
+                )
+            )
+            max_depth = max(get_trie_depth(trie) for trie in tries)
+            generation_kwargs["max_new_tokens"] = min(self.max_new_tokens, max_depth)
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                do_sample=False,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generation_kwargs,
+            )
+        outputs = outputs[:, inputs["input_ids"].shape[1] :]
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+    def _encode(self, text):
+        input_ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        return input_ids
+
+    def _greedy_decode(self, input_ids, past_key_values=None, trie=None):
+        import torch
+
+        eos_token_id = self.tokenizer.eos_token_id
+        input_ids = torch.tensor([input_ids], device=self.device)
+        generated = []
+        with torch.no_grad():
+            for _ in range(self.max_new_tokens):
+                outputs = self.model(
+                    input_ids=input_ids, past_key_values=past_key_values, use_cache=True
+                )
+                past_key_values = outputs.past_key_values
+                logits = outputs.logits[:, -1]
+                if trie is not None:
+                    allowed = get_allowed_tokens(trie, generated, eos_token_id)
+                    mask = torch.full_like(logits, float("-inf"))
+                    mask[:, allowed] = 0
+                    logits = logits + mask
+                next_token = logits.argmax(dim=-1, keepdim=True)
+                if next_token.item() == eos_token_id:
+                    break
+                generated.append(next_token.item())
+                input_ids = next_token
+
+                # stop as soon as a label is complete and cannot be extended
+                if trie is not None and get_allowed_tokens(
+                    trie, generated, eos_token_id
+                ) == [eos_token_id]:
+                    break
+        return self.tokenizer.decode(generated, skip_special_tokens=True)
+
+    def _get_prefix_cache(self, prefix):
+        import torch
+
+        if prefix not in self._prefix_caches:
+            if len(self._prefix_caches) >= self.prefix_cache_size:
+                self._prefix_caches.pop(next(iter(self._prefix_caches)))
+            prefix_ids = self._encode(prefix)
+            with torch.no_grad():
+                outputs = self.model(
+                    input_ids=torch.tensor([prefix_ids], device=self.device),
+                    use_cache=True,
+                )
+            self._prefix_caches[prefix] = (
+                prefix_ids,
+                outputs.past_key_values,
+                outputs.logits[:, -1],
+            )
+        return self._prefix_caches[prefix]
+
+    def _get_suffix_ids(self, prefix, suffix):
+        # Token ids of the sample suffix, taken from the full prompt as
+        # generate() tokenizes it: tokenized on its own, the suffix may start
+        # with different tokens (e.g. "▁Text" with SentencePiece). None if a
+        # token spans the prefix boundary.
+        prefix_ids = self._get_prefix_cache(prefix)[0]
+        prompt_ids = self._encode(prefix + suffix)
+        if prompt_ids[: len(prefix_ids)] != prefix_ids:
+            return None
+        return prompt_ids[len(prefix_ids) :]
+
+    def check_prefix_cache(self, prefix, suffix):
+        # Compares next-token logits with the cached prefix and on the full
+        # prompt, tokenized as in the uncached path
+        import torch
+
+        prefix_ids, past_key_values, _ = self._get_prefix_cache(prefix)
+        suffix_ids = self._get_suffix_ids(prefix, suffix)
+        if suffix_ids is None:
+            return False, float("nan")
+        with torch.no_grad():
+            cached = self.model(
+                input_ids=torch.tensor([suffix_ids], device=self.device),
+                past_key_values=copy.deepcopy(past_key_values),
+                use_cache=True,
+            ).logits[0, -1]
+            uncached = self.model(
+                input_ids=torch.tensor(
+                    [self._encode(prefix + suffix)], device=self.device
+                )
+            ).logits[0, -1]
+        max_diff = (cached.float() - uncached.float()).abs().max().item()
+        return max_diff <= self.prefix_cache_atol, max_diff
+
+    def _greedy_decode_batch(self, prefix, suffixes, tries=None):
+        # Greedy decoding of several sample suffixes after the same cached
+        # prefix. The cache is expanded to the batch once, and the suffixes
+        # are left-padded after the prefix (masked out, with positions that
+        # continue the prefix).
+        import torch
+
+        prefix_ids, past_key_values, _ = self._get_prefix_cache(prefix)
+        past_key_values = copy.deepcopy(past_key_values)
+        past_key_values.batch_repeat_interleave(len(suffixes))
+
+        max_length = max(len(x) for x in suffixes)
+        input_ids = torch.full(
+            (len(suffixes), max_length), self.tokenizer.pad_token_id or 0
+        )
+        attention_mask = torch.zeros(
+            (len(suffixes), len(prefix_ids) + max_length), dtype=torch.long
+        )
+        attention_mask[:, : len(prefix_ids)] = 1
+        for idx, suffix_ids in enumerate(suffixes):
+            input_ids[idx, max_length - len(suffix_ids) :] = torch.tensor(suffix_ids)
+            attention_mask[idx, len(prefix_ids) + max_length - len(suffix_ids) :] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1)[:, len(prefix_ids) :]
+
+        eos_token_id = self.tokenizer.eos_token_id
+        generated = [[] for _ in suffixes]
+        done = [False] * len(suffixes)
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = position_ids.to(self.device)
+        with torch.no_grad():
+            for _ in range(self.max_new_tokens):
+                outputs = self.model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                past_key_values = outputs.past_key_values
+                logits = outputs.logits[:, -1]
+                if tries:
+                    mask = torch.full_like(logits, float("-inf"))
+                    for idx, trie in enumerate(tries):
+                        allowed = get_allowed_tokens(trie, generated[idx], eos_token_id)
+                        mask[idx, allowed] = 0
+                    logits = logits + mask
+                next_tokens = logits.argmax(dim=-1)
+
+                for idx, token in enumerate(next_tokens.tolist()):
+                    if done[idx]:
+                        continue
+                    if token == eos_token_id:
+                        done[idx] = True
+                        continue
+                    generated[idx].append(token)
+                    # stop as soon as a label is complete and cannot be extended
+                    if tries and get_allowed_tokens(
+                        tries[idx], generated[idx], eos_token_id
+                    ) == [eos_token_id]:
+                        done[idx] = True
+                if all(done):
+                    break
+
+                input_ids = next_tokens[:, None]
+                attention_mask = torch.cat(
+                    [attention_mask, attention_mask.new_ones((len(suffixes), 1))],
+                    dim=1,
+                )
+                position_ids = position_ids[:, -1:] + 1
+        return [
+            self.tokenizer.decode(ids, skip_special_tokens=True) for ids in generated
+        ]
+
+    def generate_with_prefix_cache(self, prompts, tries=None):
+        # Samples are decoded in one batch per shared prefix
+        outputs = [None] * len(prompts)
+        groups = {}
+        for idx, (prefix, suffix) in enumerate(prompts):
+            trie = tries[idx] if tries else None
+            new_prefix = prefix and prefix not in self._prefix_caches
+            suffix_ids = self._get_suffix_ids(prefix, suffix) if prefix else None
+            if suffix_ids is None or not hasattr(
+                self._get_prefix_cache(prefix)[1], "batch_repeat_interleave"
+            ):
+                # no shared prefix, a token spans its boundary, or a legacy
+                # cache format that cannot be expanded to a batch
+                prompt_ids = self._encode(prefix + suffix)
+                outputs[idx] = self._greedy_decode(prompt_ids, trie=trie)
+                continue
+
+            if new_prefix and self.verify_prefix_cache:
+                is_valid, max_diff = self.check_prefix_cache(prefix, suffix)
+                if not is_valid:
+                    logger.warning(
+                        f"Cached prefix logits differ by {max_diff:.2e}."
+                        " Disabling prefix cache."
+                    )
+                    self.prefix_cache = False
+                    self._prefix_caches = {}
+                    return self.generate([p + s for p, s in prompts], tries=tries)
+            groups.setdefault(prefix, []).append((idx, suffix_ids, trie))
+
+        for prefix, group in groups.items():
+            idxs, suffixes, group_tries = zip(*group)
+            group_outputs = self._greedy_decode_batch(
+                prefix, suffixes, tries=list(group_tries) if tries else None
+            )
+            for idx, output in zip(idxs, group_outputs):
+                outputs[idx] = output
+        return outputs
+
+    def _get_label_candidates(self, item):
+        # (shared prefix, conditioning text, scored text) for each label. The
+        # noisy channel scores the input given "{label}: ", matching the
+        # format of the noisy-channel guideline examples; otherwise the label
+        # is scored given the classification prompt.
+        labels = list(item["labels"])
+        if item.get("noisy_channel"):
+            prefix = f"{item['context_prompt']}\n\n" if item["context_prompt"] else ""
+            return prefix, [(f"{l}: ", item["input"]) for l in labels]
+
+        prefix, suffix = self.split_prompt(item)
+        return prefix, [(suffix, f" {l}") for l in labels]
+
+    def _score_continuations(self, prefix, continuations):
+        # Log-likelihood of the scored part of every continuation, computed in
+        # a single padded forward pass that shares the prefix. Each
+        # continuation is tokenized as part of its full prompt, and the scored
+        # tokens are those that differ from the tokens of the prompt without it.
+        import torch
+
+        sequences, n_scored = [], []
+        for condition, scored in continuations:
+            sequence = self._encode(prefix + condition + scored)
+            condition_ids = self._encode(prefix + condition)
+            n_shared = 0
+            for a, b in zip(sequence, condition_ids):
+                if a != b:
+                    break
+                n_shared += 1
+            sequences.append(sequence)
+            n_scored.append(len(sequence) - n_shared)
+
+        prefix_ids, past_key_values, last_logits = [], None, None
+        if prefix and self.prefix_cache:
+            suffixes = [self._get_suffix_ids(prefix, c + s) for c, s in continuations]
+            cached_ids, cached_past, cached_logits = self._get_prefix_cache(prefix)
+            # unshared if a token spans the prefix boundary, or with a legacy
+            # cache format that cannot be expanded to a batch
+            if all(x is not None for x in suffixes) and hasattr(
+                cached_past, "batch_repeat_interleave"
+            ):
+                prefix_ids, last_logits = cached_ids, cached_logits
+                past_key_values = copy.deepcopy(cached_past)
+                past_key_values.batch_repeat_interleave(len(sequences))
+                sequences = suffixes
+
+        max_length = max(len(x) for x in sequences)
+        input_ids = torch.full(
+            (len(sequences), max_length), self.tokenizer.pad_token_id or 0
+        )
+        attention_mask = torch.zeros((len(sequences), len(prefix_ids) + max_length))
+        attention_mask[:, : len(prefix_ids)] = 1
+        for idx, sequence in enumerate(sequences):
+            input_ids[idx, : len(sequence)] = torch.tensor(sequence)
+            attention_mask[idx, len(prefix_ids) : len(prefix_ids) + len(sequence)] = 1
+
+        with torch.no_grad():
+            logits = self.model(
+                input_ids=input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                past_key_values=past_key_values,
+            ).logits.float()
+
+        # logits predicting each input token come from the previous position
+        if last_logits is None:
+            last_logits = torch.zeros_like(logits[:, :1])
+        else:
+            last_logits = last_logits.float().expand(len(sequences), -1)[:, None]
+        logits = torch.cat([last_logits, logits[:, :-1]], dim=1)
+        log_probs = torch.log_softmax(logits, dim=-1)
+        log_probs = log_probs.gather(-1, input_ids.to(self.device)[..., None])[..., 0]
+
+        scores = []
+        for idx, sequence in enumerate(sequences):
+            start = len(sequence) - n_scored[idx]
+            scores.append(log_probs[idx, start : len(sequence)].sum().item())
+        return scores
+
+    def score_labels(self, items):
+        # Normalized label probabilities for each item
+        import torch
+
+        label_scores = []
+        for item in items:
+            prefix, continuations = self._get_label_candidates(item)
+            scores = self._score_continuations(prefix, continuations)
+            probs = torch.softmax(torch.tensor(scores), dim=0).tolist()
+            label_scores.append(dict(zip(item["labels"], probs)))
+        return label_scores
+
+    @property
+    def generation_kwargs(self):
+        return dict(
+            checkpoint_path=self.model_path,
+            max_new_tokens=self.max_new_tokens,
+            constrained_decoding=self.constrained_decoding,
+            label_scoring=self.label_scoring,
+            # numerics of the loaded weights, e.g. "torch.bfloat16" on "cuda"
+            dtype=str(self.dtype),
+            device=str(self.device),
+        )
+
+    def get_outputs(self, items):
+        # Raw outputs: generated text, or label probabilities with label_scoring
+        if self.label_scoring:
+            return self.score_labels(items)
+
+        tries = None
+        if self.constrained_decoding:
+            tries = [self.get_label_trie(item["labels"]) for item in items]
+
+        if self.prefix_cache:
+            prompts = [self.split_prompt(item) for item in items]
+            outputs = self.generate_with_prefix_cache(prompts, tries=tries)
+        else:
+            prompts = [self.build_prompt(item) for item in items]
+            outputs = self.generate(prompts, tries=tries)
+        return outputs
+
+    def classify(self, items):
+        outputs = self.get_outputs(items)
+        return [parse_output(o, item["labels"]) for o, item in zip(outputs, items)]
+
+    def close(self):
+        import torch
+
+        logger.info(f"Unloading model {self.model_path}...")
+        self._prefix_caches.clear()
+        self._label_tries.clear()
+        del self.model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+class OpenAIClassifier:
+    # Chat completions client driven by the asynchronous RequestScheduler
+    concurrent = True
+
+    def __init__(
+        self,
+        model_name,
+        api_key=None,
+        base_url=None,
+        max_tokens=256,
+        temperature=0,
+        max_concurrency=8,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        request_interval=None,
+        max_retries=6,
+        timeout=60,
+        ignore_errors=False,
+        seed=17,
+        **kwargs,
+    ):
+        self.model_name = model_name
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        if base_url is None:
+            base_url = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.timeout = timeout
+
+        # --model_request_interval used to be a fixed sleep between calls
+        if request_interval and not requests_per_minute:
+            requests_per_minute = 60 / request_interval
+            logger.info(
+                f"Request interval of {request_interval}s: scheduling up to"
+                f" {requests_per_minute:g} requests per minute with up to"
+                f" {max_concurrency} concurrent requests"
+            )
+        self.scheduler = RequestScheduler(
+            self._request,
+            max_concurrency=max_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_retries=max_retries,
+            ignore_errors=ignore_errors,
+            seed=seed,
+        )
+
+    def build_prompt(self, item):
+        return build_prompt(item["context_prompt"], item["input"], item["label_type"])
+
+    def count_tokens(self, prompts):
+        # rough estimate, used for batching and the tokens/min budget
+        return [len(prompt) // 4 + 1 for prompt in prompts]
+
+    def _request(self, prompt):
+        payload = dict(
+            model=self.model_name,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+        )
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode(),
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {self.api_key}",
+            },
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                output = json.loads(response.read())
+        except urllib.error.HTTPError as err:
+            if err.code == 429 or err.code >= 500:
+                retry_after = err.headers.get("Retry-After")
+                retry_after = float(retry_after) if retry_after else None
+                raise RetryableError(f"HTTP {err.code}: {err.reason}.", retry_after)
+            raise
+        except (urllib.error.URLError, TimeoutError) as err:
+            raise RetryableError(f"Request error: {err}.")
+        return output["choices"][0]["message"]["content"]
+
+    @property
+    def generation_kwargs(self):
+        return dict(max_tokens=self.max_tokens, temperature=self.temperature)
+
+    def get_outputs(self, items):
+        prompts = [self.build_prompt(item) for item in items]
+        n_tokens = [n + self.max_tokens for n in self.count_tokens(prompts)]
+        return self.scheduler.run(prompts, n_tokens=n_tokens)
+
+    def classify(self, items):
+        outputs = self.get_outputs(items)
+        return [parse_output(o, item["labels"]) for o, item in zip(outputs, items)]
+
+
+class FakeClassifier:
+    # Stand-in model for benchmarks and regression checks without a GPU or an
+    # API key. Each output is drawn from `label_distribution` (label weights,
+    # uniform by default) with a random generator seeded by the prompt, so
+    # runs are reproducible and independent of batching. Each batch takes
+    # `latency` seconds plus the time to generate its outputs at
+    # `tokens_per_second`, and fails with probability `error_rate`.
+    def __init__(
+        self,
+        model_name,
+        latency=0,
+        tokens_per_second=None,
+        error_rate=0,
+        label_distribution=None,
+        ignore_errors=False,
+        seed=17,
+        **kwargs,
+    ):
+        self.model_name = model_name
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.label_distribution = label_distribution
+        self.ignore_errors = ignore_errors
+        self.seed = seed
+
+    def build_prompt(self, item):
+        return build_prompt(item["context_prompt"], item["input"], item["label_type"])
+
+    def count_tokens(self, prompts):
+        return [len(prompt) // 4 + 1 for prompt in prompts]
+
+    @property
+    def generation_kwargs(self):
+        return dict(
+            seed=self.seed,
+            error_rate=self.error_rate,
+            label_distribution=self.label_distribution,
+        )
+
+    def _get_random(self, prompt):
+        digest = hashlib.sha256(f"{self.seed}\n{prompt}".encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], "little"))
+
+    def _get_output(self, item):
+        random_ = self._get_random(self.build_prompt(item))
+        if random_.random() < self.error_rate:
+            if not self.ignore_errors:
+                raise RuntimeError(f"Simulated error of {self.model_name}.")
+            return None
+        if "fields" in item:
+            # multi-concept items are answered with one line per concept
+            return "\n".join(
+                f"{field}: {self._get_label(labels, random_)}"
+                for field, labels in item["fields"].items()
+            )
+        return self._get_label(item["labels"], random_)
+
+    def _get_label(self, labels, random_):
+        labels = list(labels)
+        weights = None
+        if self.label_distribution:
+            weights = [self.label_distribution.get(l, 0) for l in labels]
+            if not any(weights):
+                weights = None
+        return random_.choices(labels, weights=weights)[0]
+
+    def get_outputs(self, items):
+        outputs = [self._get_output(item) for item in items]
+        delay = self.latency
+        if self.tokens_per_second:
+            generated = [o for o in outputs if o is not None]
+            delay += sum(self.count_tokens(generated)) / self.tokens_per_second
+        if delay:
+            time.sleep(delay)
+        return outputs
+
+    def classify(self, items):
+        outputs = self.get_outputs(items)
+        return [parse_output(o, item["labels"]) for o, item in zip(outputs, items)]
+
+
+def is_fake_model(model_name):
+    return str(model_name).startswith("fake")
+
+
+def get_classifier(model_name, **kwargs):
+    logger.info(f"Using model: {model_name}")
+    if is_fake_model(model_name):
+        return FakeClassifier(model_name, **kwargs)
+    if model_name.startswith("gpt-"):
+        return OpenAIClassifier(model_name, **kwargs)
+    return HFClassifier(model_name, **kwargs)
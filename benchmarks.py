@@ -0,0 +1,312 @@
+from functools import partial
+from glob import glob
+import json
+import logging
+from pathlib import Path
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import fire
+import numpy as np
+import pandas as pd
+
+from engine import ModelSession
+from run import (
+    GUIDELINES,
+    evaluate,
+    get_label_permutation,
+    guideline_effect,
+    guideline_effect_batch,
+    sample_balanced,
+)
+from run_factuality_level import _get_domain_config
+from run_guideline_adherence import get_guideline_effects
+from run_guidelines import _get_domain_configs
+
+logger = logging.getLogger(__name__)
+
+BENCHMARKS_PATH = Path("output") / "benchmarks"
+DATASET_PATH = "data/financial_reports.csv"
+
+# concepts with 5 and 10 labels
+PERMUTATION_CONCEPTS = {5: ("scientific", "coresc"), 10: ("financial", "content")}
+
+ENTRY_POINTS = [
+    "run",
+    "run_guidelines",
+    "run_factuality_level",
+    "run_guideline_adherence",
+    "run_multi_concept",
+]
+# loaded only when a model is instantiated, results are written or a plot is
+# drawn
+HEAVY_MODULES = [
+    "pandas",
+    "pyarrow",
+    "torch",
+    "transformers",
+    "llms",
+    "matplotlib",
+    "seaborn",
+]
+IMPORT_TIME_BUDGET = 1.0
+
+
+def _get_version():
+    try:
+        command = ["git", "rev-parse", "--short", "HEAD"]
+        return subprocess.check_output(command, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _time_once(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _time(fn, repeats=3, warmup=True):
+    # with `warmup`, the first call (which fills caches such as the
+    # similarity matrices) is reported separately from the repeats
+    first = _time_once(fn) if warmup else None
+    times = [_time_once(fn) for _ in range(repeats)]
+    return dict(
+        first=first,
+        repeats=repeats,
+        min=min(times),
+        median=float(np.median(times)),
+        mean=float(np.mean(times)),
+    )
+
+
+def _get_labels(domain, concept):
+    concept_guidelines = GUIDELINES[domain][concept]
+    labels = concept_guidelines.get("labels")
+    if labels is None:
+        labels = sorted(concept_guidelines["definition"].keys())
+    return labels
+
+
+def bench_label_permutation(n_labels, n_permutations=100, seed=17):
+    labels = _get_labels(*PERMUTATION_CONCEPTS[n_labels])
+
+    def fn():
+        for idx in range(n_permutations):
+            get_label_permutation(
+                labels, "random", random.Random(seed), permutation_idx=idx, shuffle=True
+            )
+
+    return fn
+
+
+def bench_sample_balanced(n_rows=30000, seed=17):
+    data = pd.read_csv(DATASET_PATH)
+    data = data.sample(n_rows, replace=True, random_state=seed)
+    sources, targets = data["text"], data["capital"]
+    return partial(sample_balanced, sources, targets, max_samples=540)
+
+
+def _get_guideline_effect_inputs(n_samples=540, seed=17):
+    labels = _get_labels("financial", "capital")
+    random_ = random.Random(seed)
+    shuffled = random_.sample(labels, len(labels))
+    label_permutation = dict(zip(shuffled, labels))
+    predictions = [random_.choice(labels) for _ in range(n_samples)]
+    factual = [random_.choice(labels) for _ in range(n_samples)]
+    factual = np.asarray(factual, dtype=object)
+    return predictions, label_permutation, factual.__getitem__
+
+
+def bench_guideline_effect(n_samples=540):
+    predictions, label_permutation, factual_prediction_fn = (
+        _get_guideline_effect_inputs(n_samples)
+    )
+
+    def fn():
+        for idx, prediction in enumerate(predictions):
+            guideline_effect(
+                prediction,
+                label_permutation=label_permutation,
+                factual_prediction_fn=factual_prediction_fn,
+                index=idx,
+            )
+
+    return fn
+
+
+def bench_guideline_effect_batch(n_samples=540):
+    predictions, label_permutation, factual_prediction_fn = (
+        _get_guideline_effect_inputs(n_samples)
+    )
+    return partial(
+        guideline_effect_batch,
+        predictions,
+        label_permutation=label_permutation,
+        factual_prediction_fn=factual_prediction_fn,
+        indices=list(range(n_samples)),
+    )
+
+
+def _get_sweep_kwargs(kwargs, output_dir, model_kwargs):
+    kwargs = dict(kwargs, output_dir=str(output_dir), use_model_cache=False)
+    kwargs.update({f"model_{k}": v for k, v in model_kwargs.items()})
+    return kwargs
+
+
+def bench_guidelines_sweep(output_dir, model_name="fake", **model_kwargs):
+    # all label noise conditions of run_guidelines.py on the financial domain
+    configs = _get_domain_configs("financial", model_name, None, None)
+
+    def fn():
+        with ModelSession(model_name, seed=17, **model_kwargs) as session:
+            for kwargs in configs:
+                kwargs = _get_sweep_kwargs(kwargs, output_dir, model_kwargs)
+                evaluate(classifier=session.classifier, **kwargs)
+
+    return fn
+
+
+def bench_factuality_level_sweep(
+    output_dir, model_name="fake", n_permutations=None, **model_kwargs
+):
+    # the random permutation sweep of run_factuality_level.py
+    kwargs = _get_domain_config("financial", model_name, None, None, False)
+    kwargs = _get_sweep_kwargs(kwargs, output_dir, model_kwargs)
+    if n_permutations:
+        kwargs["n_permutations"] = n_permutations
+    return partial(evaluate, **kwargs)
+
+
+def bench_guideline_effects(output_dir):
+    paths = glob(f"{output_dir}/**/*_metrics_per_sample.csv", recursive=True)
+    return partial(get_guideline_effects, paths, cache_path=None)
+
+
+def get_import_time(module):
+    # import time of a module in a fresh interpreter, like a CLI call or a
+    # sweep worker, and the heavy modules it loaded
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "print(json.dumps(dict(time=time.perf_counter() - start,"
+        f" modules=[m for m in {HEAVY_MODULES} if m in sys.modules])))"
+    )
+    cwd = Path(__file__).resolve().parent
+    output = subprocess.check_output([sys.executable, "-c", code], cwd=cwd)
+    return json.loads(output)
+
+
+def check_import_times(budget=IMPORT_TIME_BUDGET, repeats=3):
+    # Fails if an entry point takes longer than `budget` seconds to import
+    # (best of `repeats`) or loads any of HEAVY_MODULES at import time; run by
+    # tests/test_import_time.py
+    results = {}
+    errors = []
+    for module in ENTRY_POINTS:
+        runs = [get_import_time(module) for _ in range(repeats)]
+        import_time = min(r["time"] for r in runs)
+        heavy_modules = runs[0]["modules"]
+        results[module] = dict(time=import_time, heavy_modules=heavy_modules)
+        logger.info(f"Import time of {module}: {import_time:.3f}s")
+        if import_time > budget:
+            errors.append(f"{module} took {import_time:.3f}s (budget: {budget}s)")
+        if heavy_modules:
+            errors.append(f"{module} imported {heavy_modules}")
+    if errors:
+        raise AssertionError("Import time regression: " + "; ".join(errors))
+    return results
+
+
+def run_benchmarks(
+    output_path=None,
+    repeats=3,
+    sweep_repeats=1,
+    n_permutations=None,
+    model_name="fake",
+    **model_kwargs,
+):
+    # Times the hot helpers and full sweeps with the fake model (see
+    # backends.FakeClassifier; e.g. --latency=0.5 --tokens_per_second=50)
+    # and writes the results as JSON, so that versions can be compared with
+    # compare_benchmarks
+    results = {}
+    for module in ENTRY_POINTS:
+        import_times = [get_import_time(module)["time"] for _ in range(repeats)]
+        results[f"import_{module}"] = dict(
+            repeats=repeats,
+            min=min(import_times),
+            median=float(np.median(import_times)),
+            mean=float(np.mean(import_times)),
+        )
+    for n_labels in PERMUTATION_CONCEPTS:
+        fn = bench_label_permutation(n_labels)
+        results[f"get_label_permutation_{n_labels}_labels"] = _time(fn, repeats)
+    results["sample_balanced_30k"] = _time(bench_sample_balanced(), repeats)
+    results["guideline_effect"] = _time(bench_guideline_effect(), repeats)
+    results["guideline_effect_batch"] = _time(bench_guideline_effect_batch(), repeats)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        factuality_dir = Path(tmp_dir) / "factuality_level"
+        fn = bench_factuality_level_sweep(
+            factuality_dir, model_name, n_permutations, **model_kwargs
+        )
+        results["factuality_level_sweep"] = _time(fn, sweep_repeats, warmup=False)
+        fn = bench_guideline_effects(factuality_dir)
+        results["get_guideline_effects"] = _time(fn, repeats)
+        fn = bench_guidelines_sweep(
+            Path(tmp_dir) / "guidelines", model_name, **model_kwargs
+        )
+        results["guidelines_sweep"] = _time(fn, sweep_repeats, warmup=False)
+
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    report = dict(
+        version=_get_version(),
+        timestamp=timestr,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        model_name=model_name,
+        model_kwargs=model_kwargs,
+        benchmarks=results,
+    )
+    if output_path is None:
+        output_path = BENCHMARKS_PATH / f"benchmarks_{timestr}.json"
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Benchmark results saved to {output_path}")
+    return report
+
+
+def compare_benchmarks(baseline_path, path, threshold=1.1):
+    # Median time ratios of two result files; ratios above `threshold` are
+    # reported as regressions
+    with open(baseline_path) as f:
+        baseline = json.load(f)["benchmarks"]
+    with open(path) as f:
+        current = json.load(f)["benchmarks"]
+
+    ratios = {}
+    for name in sorted(set(baseline) & set(current)):
+        ratios[name] = current[name]["median"] / baseline[name]["median"]
+        message = f"{name}: {ratios[name]:.2f}x"
+        if ratios[name] > threshold:
+            logger.warning(f"Regression in {message}")
+        else:
+            logger.info(message)
+    return ratios
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(
+        dict(
+            run=run_benchmarks,
+            compare=compare_benchmarks,
+        )
+    )
@@ -0,0 +1,89 @@
+import logging
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def get_label_documents(context_prompt, labels, label_type):
+    # Text describing each label as the model sees it in the context prompt:
+    # the label name, its (possibly permuted) definition and its examples
+    docs = {label: [label] for label in labels}
+    lines = (context_prompt or "").split("\n")
+    for line in lines:
+        for label in labels:
+            if line.startswith(f"- {label}: "):
+                docs[label].append(line[len(f"- {label}: ") :])
+
+    example_pattern = re.compile(rf"Text: (.*)\n{re.escape(label_type)}: (.*)")
+    for text, label in example_pattern.findall(context_prompt or ""):
+        if label in docs:
+            docs[label].append(text)
+    return {label: " ".join(parts) for label, parts in docs.items()}
+
+
+def _get_tfidf(documents, vocabulary):
+    counts = np.zeros((len(documents), len(vocabulary)))
+    for row, tokens in enumerate(documents):
+        for token in tokens:
+            col = vocabulary.get(token)
+            if col is not None:
+                counts[row, col] += 1
+    return np.log1p(counts)
+
+
+class TfidfCascade:
+    # CPU-only first stage of the cascade: TF-IDF cosine similarity between
+    # each input and the label documents of its context prompt. Samples whose
+    # top label probability is below `threshold` are left to the LLM. With
+    # `baseline_samples`, that many samples per job are also sent to the LLM
+    # to measure the accuracy of the cascade against an all-LLM run.
+    def __init__(self, threshold=0.9, temperature=0.05, baseline_samples=None):
+        self.threshold = threshold
+        self.temperature = temperature
+        self.baseline_samples = baseline_samples
+
+    def _score_group(self, label_docs, inputs):
+        labels = list(label_docs)
+        documents = [tokenize(label_docs[l]) for l in labels]
+        documents += [tokenize(x) for x in inputs]
+        vocabulary = {}
+        for tokens in documents:
+            for token in tokens:
+                vocabulary.setdefault(token, len(vocabulary))
+
+        tfidf = _get_tfidf(documents, vocabulary)
+        doc_freq = (tfidf > 0).sum(axis=0)
+        tfidf *= np.log((1 + len(documents)) / (1 + doc_freq)) + 1
+        norms = np.linalg.norm(tfidf, axis=1, keepdims=True)
+        tfidf /= np.where(norms == 0, 1, norms)
+
+        similarities = tfidf[len(labels) :] @ tfidf[: len(labels)].T
+        logits = similarities / self.temperature
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        return [dict(zip(labels, p.tolist())) for p in probs]
+
+    def score(self, items):
+        groups = {}
+        for idx, item in enumerate(items):
+            key = (item["context_prompt"], tuple(item["labels"]), item["label_type"])
+            groups.setdefault(key, []).append(idx)
+
+        scores = [None] * len(items)
+        for (context_prompt, labels, label_type), idxs in groups.items():
+            label_docs = get_label_documents(context_prompt, labels, label_type)
+            inputs = [items[idx]["input"] for idx in idxs]
+            for idx, label_scores in zip(idxs, self._score_group(label_docs, inputs)):
+                scores[idx] = label_scores
+        return scores
+
+    def is_confident(self, label_scores):
+        return max(label_scores.values()) >= self.threshold
@@ -0,0 +1,62 @@
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _to_json(value):
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+class Checkpoint:
+    # Append-only JSON lines store of finished work. Every update is flushed
+    # and fsynced, so a crash loses at most the batch being written; a torn
+    # last line is ignored when the file is loaded with `resume`.
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.records = {}
+        self._lock = threading.Lock()
+        if resume and self.path.exists():
+            self._load()
+        else:
+            self.path.write_text("")
+
+    def _load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Ignoring incomplete record in {self.path}")
+                    break
+                self.records[record["key"]] = record["value"]
+        logger.info(f"Loaded {len(self.records)} records from {self.path}")
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key, default=None):
+        return self.records.get(key, default)
+
+    def update(self, values):
+        if not values:
+            return
+        lines = [
+            json.dumps(dict(key=key, value=value), default=_to_json) + "\n"
+            for key, value in values.items()
+        ]
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.records.update(values)
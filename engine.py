@@ -0,0 +1,792 @@
+import json
+import logging
+from pathlib import Path
+import random
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from backends import get_classifier, parse_output
+from metrics import (
+    aggregate_metrics,
+    bootstrap_interval,
+    get_length_diff,
+    get_resample_counts,
+    get_text_stats,
+)
+from prediction_cache import PredictionCache, get_cache_key
+from sampling import load_samples_streaming
+from timings import StageTimer
+
+logger = logging.getLogger(__name__)
+
+# Requests per batch for classifiers that schedule their own requests: large
+# enough to keep them busy, small enough to checkpoint progress regularly
+CONCURRENT_BATCH_SIZE = 256
+
+# evaluate_classifier arguments that describe a run rather than the model
+JOB_KEYS = [
+    "model_name",
+    "model_context_prompt",
+    "model_labels",
+    "model_label_type",
+    "model_noisy_channel",
+]
+
+
+def read_dataset(dataset_name):
+    if Path(dataset_name).suffix in [".json", ".jsonl"]:
+        data = pd.read_json(dataset_name, lines=dataset_name.endswith(".jsonl"))
+    else:
+        data = pd.read_csv(dataset_name)
+    logger.info(f"Loaded {len(data)} samples from {dataset_name}")
+    return data
+
+
+def load_samples(
+    dataset_name,
+    source_key,
+    target_key,
+    preprocess_fn=None,
+    max_samples=None,
+    shuffle=False,
+    seed=17,
+    streaming=False,
+    balanced=False,
+):
+    if not isinstance(source_key, str):
+        raise ValueError(f"Unsupported source_key for local evaluation: {source_key}")
+    if streaming:
+        # balanced sampling is done while reading, so preprocess_fn is unused
+        return load_samples_streaming(
+            dataset_name,
+            source_key,
+            target_key,
+            max_samples=max_samples,
+            shuffle=shuffle,
+            balanced=balanced,
+            seed=seed,
+        )
+
+    data = read_dataset(dataset_name)
+    sources, targets = data[source_key], data[target_key]
+    if preprocess_fn:
+        sources, targets = preprocess_fn(
+            sources, targets, max_samples=max_samples, logger=logger
+        )
+    else:
+        sources, targets = sources.tolist(), targets.tolist()
+
+    if shuffle:
+        logger.info(f"Shuffling data using seed: {seed}")
+        idxs = list(range(len(sources)))
+        random.Random(seed).shuffle(idxs)
+        sources = [sources[idx] for idx in idxs]
+        targets = [targets[idx] for idx in idxs]
+
+    if max_samples:
+        sources, targets = sources[:max_samples], targets[:max_samples]
+    return sources, targets
+
+
+def make_batches(lengths, batch_size=None, max_batch_tokens=None):
+    # Longest prompts first, so that padding is minimal within each batch and
+    # out-of-memory errors show up at the start of the run.
+    order = np.argsort(lengths, kind="stable")[::-1]
+    batches = []
+    batch = []
+    batch_max_length = 0
+    for idx in order:
+        length = max(batch_max_length, lengths[idx])
+        batch_full = batch_size and len(batch) >= batch_size
+        if max_batch_tokens and batch:
+            batch_full = batch_full or length * (len(batch) + 1) > max_batch_tokens
+        if batch_full:
+            batches.append(batch)
+            batch = []
+            length = lengths[idx]
+        batch.append(int(idx))
+        batch_max_length = length
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def get_model_kwargs(kwargs):
+    return {
+        k[len("model_") :]: v
+        for k, v in kwargs.items()
+        if k.startswith("model_") and k not in JOB_KEYS
+    }
+
+
+def get_output_dir(output_dir, dataset_name, timestr, run_id):
+    return Path(output_dir) / f"{Path(dataset_name).stem}_{timestr}_{run_id}"
+
+
+def _get_file_prefix(model_name):
+    return re.sub(r"\W", "_", Path(model_name).name)
+
+
+def _get_per_sample_metrics(
+    predictions, references, sources, metrics=None, indices=None
+):
+    if indices is None:
+        indices = range(len(predictions))
+    per_sample_metrics = []
+    for metric in metrics or []:
+        metric_fn = metric["metric_fn"]
+        metric_kwargs = metric.get("metric_kwargs", {})
+        if "batch_metric_fn" in metric:
+            scores = metric["batch_metric_fn"](
+                predictions, indices=list(indices), **metric_kwargs
+            )
+        else:
+            scores = [
+                metric_fn(pred, reference=ref, source=src, index=idx, **metric_kwargs)
+                for idx, pred, ref, src in zip(
+                    indices, predictions, references, sources
+                )
+            ]
+        per_sample_metrics.append(pd.DataFrame(scores))
+
+    references_str = [str(x) for x in references]
+    # case-insensitive, like llms
+    exact_match = [
+        str(p).lower() == r.lower() for p, r in zip(predictions, references_str)
+    ]
+    partial_match = [
+        str(r).lower() in str(p).lower() or str(p).lower() in str(r).lower()
+        for p, r in zip(predictions, references_str)
+    ]
+    # same columns as the classification metrics of llms
+    stats = {}
+    for group, texts in [
+        ("source_stats", sources),
+        ("prediction_stats", predictions),
+        ("reference_stats", references_str),
+    ]:
+        stats[group] = [get_text_stats(str(x)) for x in texts]
+    stats["length_diff"] = [
+        get_length_diff(p, r)
+        for p, r in zip(stats["prediction_stats"], stats["reference_stats"])
+    ]
+    columns = {}
+    for group, values in stats.items():
+        for name in values[0] if values else []:
+            columns[f"classification_metrics_{group}_{name}"] = [
+                x[name] for x in values
+            ]
+    columns["classification_metrics_exact_match"] = exact_match
+    columns["classification_metrics_partial_match"] = partial_match
+    classification_metrics = pd.DataFrame(columns)
+    per_sample_metrics.append(classification_metrics)
+    return pd.concat(per_sample_metrics, axis=1)
+
+
+def save_result(result, job_kwargs, per_sample_metrics):
+    output_dir = get_output_dir(
+        job_kwargs.get("output_dir", "output"),
+        job_kwargs["dataset_name"],
+        job_kwargs["timestr"],
+        job_kwargs["run_id"],
+    )
+    output_dir.mkdir(parents=True, exist_ok=True)
+    file_prefix = _get_file_prefix(job_kwargs["model_name"])
+
+    predictions_path = output_dir / f"{file_prefix}_predictions.csv"
+    predictions = dict(prediction=result["predictions"], reference=result["references"])
+    if result.get("stages"):
+        # the cascade stage that answered each sample
+        predictions["stage"] = result["stages"]
+    pd.DataFrame(predictions).to_csv(predictions_path, index=False)
+    per_sample_metrics.to_csv(
+        output_dir / f"{file_prefix}_metrics_per_sample.csv", index=False
+    )
+    with open(output_dir / f"{file_prefix}_metrics.json", "w") as f:
+        json.dump(result["agg_scores"], f, indent=2)
+    if result.get("cascade"):
+        with open(output_dir / f"{file_prefix}_cascade.json", "w") as f:
+            json.dump(result["cascade"], f, indent=2)
+    if result.get("label_scores"):
+        pd.DataFrame(result["label_scores"]).to_csv(
+            output_dir / f"{file_prefix}_label_scores.csv", index=False
+        )
+
+    result["output_path"] = str(predictions_path)
+    logger.info(f"Results saved to {output_dir}")
+
+
+class ModelSession:
+    # Loads a classifier once and shares it across evaluate calls, e.g. all
+    # label noise conditions and domains of a sweep. The model is loaded on
+    # first use and released by close().
+    def __init__(self, model_name, **model_kwargs):
+        self.model_name = model_name
+        self.model_kwargs = model_kwargs
+        self._classifier = None
+
+    @property
+    def classifier(self):
+        if self._classifier is None:
+            self._classifier = get_classifier(self.model_name, **self.model_kwargs)
+        return self._classifier
+
+    def close(self):
+        if self._classifier is not None and hasattr(self._classifier, "close"):
+            self._classifier.close()
+        self._classifier = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _get_cache_keys(classifier, items):
+    keys = []
+    for item in items:
+        generation_kwargs = dict(
+            classifier.generation_kwargs,
+            labels=sorted(item["labels"]),
+            label_type=item["label_type"],
+            noisy_channel=item.get("noisy_channel", False),
+        )
+        key = get_cache_key(
+            classifier.model_name,
+            item["context_prompt"],
+            item["input"],
+            generation_kwargs,
+        )
+        keys.append(key)
+    return keys
+
+
+def _get_outputs(classifier, items, keys, prediction_cache=None):
+    if prediction_cache is None:
+        return classifier.get_outputs(items)
+
+    cached = prediction_cache.get_many(keys)
+    missing = [idx for idx, key in enumerate(keys) if key not in cached]
+    if missing:
+        new_outputs = classifier.get_outputs([items[idx] for idx in missing])
+        # failed requests (None) are not cached
+        new_outputs = {
+            keys[idx]: output
+            for idx, output in zip(missing, new_outputs)
+            if output is not None
+        }
+        prediction_cache.set_many(new_outputs)
+        cached.update(new_outputs)
+    return [cached.get(key) for key in keys]
+
+
+def _get_item_batches(
+    classifier, idxs, lengths, n_samples, batch_size, max_batch_tokens
+):
+    if getattr(classifier, "concurrent", False):
+        # the classifier schedules the requests of each batch concurrently
+        return [
+            idxs[start : start + CONCURRENT_BATCH_SIZE]
+            for start in range(0, len(idxs), CONCURRENT_BATCH_SIZE)
+        ]
+
+    groups = [idxs]
+    if getattr(classifier, "prefix_cache", False):
+        # keep each permutation together so that its context prompt is
+        # encoded once and reused from the prefix cache
+        groups = {}
+        for idx in idxs:
+            groups.setdefault(idx // n_samples, []).append(idx)
+        groups = list(groups.values())
+
+    batches = []
+    for group in groups:
+        group_lengths = [lengths[idx] for idx in group]
+        group_batches = make_batches(group_lengths, batch_size, max_batch_tokens)
+        batches.extend([[group[idx] for idx in b] for b in group_batches])
+    return batches
+
+
+def _add_batch_timings(timer, classifier, run_ids, lengths, outputs, wall, cpu):
+    # the time of a batch is split between its permutations by sample count
+    # label scores and failed requests generate no tokens
+    generated = [idx for idx, o in enumerate(outputs) if isinstance(o, str) and o]
+    generated_lengths = [0] * len(outputs)
+    if generated:
+        counts = classifier.count_tokens([outputs[idx] for idx in generated])
+        for idx, count in zip(generated, counts):
+            generated_lengths[idx] = count
+    jobs = {}
+    for run_id, length, generated_length in zip(run_ids, lengths, generated_lengths):
+        job = jobs.setdefault(run_id, [0, 0, 0])
+        job[0] += 1
+        job[1] += int(length)
+        job[2] += int(generated_length)
+    for run_id, (n_samples, prompt_tokens, generated_tokens) in jobs.items():
+        share = n_samples / len(run_ids)
+        timer.add(
+            "inference",
+            key=run_id,
+            wall=wall * share,
+            cpu=cpu * share,
+            samples=n_samples,
+            prompt_tokens=prompt_tokens,
+            generated_tokens=generated_tokens,
+        )
+    timer.add("inference", wall=wall, cpu=cpu, calls=1, samples=len(run_ids))
+
+
+def get_item_outputs(
+    classifier, items, batch_size=8, max_batch_tokens=None, prediction_cache=None
+):
+    # Outputs of a list of independent items, batched like the items of
+    # evaluate_classifier_batched. Also returns the prompt lengths.
+    lengths = classifier.count_tokens([classifier.build_prompt(x) for x in items])
+    keys = _get_cache_keys(classifier, items)
+    idxs = list(range(len(items)))
+    batches = _get_item_batches(
+        classifier, idxs, lengths, len(items), batch_size, max_batch_tokens
+    )
+    outputs = [None] * len(items)
+    for batch in batches:
+        batch_outputs = _get_outputs(
+            classifier,
+            [items[idx] for idx in batch],
+            [keys[idx] for idx in batch],
+            prediction_cache,
+        )
+        for idx, output in zip(batch, batch_outputs):
+            outputs[idx] = output
+    return outputs, lengths
+
+
+def _set_job_result(result, job_idx, sample_idxs, items, outputs, references):
+    offset = job_idx * len(references)
+    job_outputs = [outputs[offset + idx] for idx in sample_idxs]
+    labels = items[offset]["labels"]
+    result.update(
+        predictions=[parse_output(o, labels) for o in job_outputs],
+        references=[references[idx] for idx in sample_idxs],
+        n_samples=len(sample_idxs),
+    )
+    if all(isinstance(o, dict) for o in job_outputs):
+        result["label_scores"] = job_outputs
+
+
+def get_stratified_order(references, seed=17):
+    # Random sample order in which every prefix has about the same class
+    # proportions as the full set: the samples of each class are shuffled
+    # and spread evenly over the order.
+    random_ = random.Random(seed)
+    classes = {}
+    for idx, reference in enumerate(references):
+        classes.setdefault(str(reference), []).append(idx)
+    positions = []
+    for label in sorted(classes):
+        idxs = classes[label]
+        random_.shuffle(idxs)
+        for rank, idx in enumerate(idxs):
+            positions.append(((rank + random_.random()) / len(idxs), idx))
+    return [idx for _, idx in sorted(positions)]
+
+
+def _run_early_stopping(
+    jobs,
+    items,
+    outputs,
+    sources,
+    references,
+    run_items,
+    ci_width,
+    chunk_size=50,
+    min_samples=100,
+    metric="exact_match",
+):
+    # Evaluates the permutations in stratified chunks of samples and stops
+    # each one once the bootstrap interval of `metric` is narrower than
+    # `ci_width`. Jobs with early_stopping=False (the factual baseline) are
+    # evaluated first and in full, since the others are compared with them.
+    n_samples = len(sources)
+    job_samples = [list(range(n_samples)) for _ in jobs]
+    full_jobs = [
+        j for j, (kw, _) in enumerate(jobs) if not kw.get("early_stopping", True)
+    ]
+    run_items([j * n_samples + idx for j in full_jobs for idx in range(n_samples)])
+    for job_idx in full_jobs:
+        _set_job_result(
+            jobs[job_idx][1], job_idx, job_samples[job_idx], items, outputs, references
+        )
+
+    order = get_stratified_order(references, seed=jobs[0][0].get("seed", 17))
+    n_done = {j: 0 for j in range(len(jobs)) if j not in full_jobs}
+    while n_done:
+        run_items(
+            [
+                j * n_samples + idx
+                for j, start in n_done.items()
+                for idx in order[start : start + chunk_size]
+            ]
+        )
+        for job_idx in list(n_done):
+            n_done[job_idx] = min(n_done[job_idx] + chunk_size, n_samples)
+            sample_idxs = sorted(order[: n_done[job_idx]])
+            job_samples[job_idx] = sample_idxs
+            if n_done[job_idx] == n_samples:
+                del n_done[job_idx]
+                continue
+            if n_done[job_idx] < min_samples:
+                continue
+
+            job_kwargs, result = jobs[job_idx]
+            _set_job_result(result, job_idx, sample_idxs, items, outputs, references)
+            per_sample_metrics = _get_per_sample_metrics(
+                result["predictions"],
+                result["references"],
+                [sources[idx] for idx in sample_idxs],
+                metrics=job_kwargs.get("metrics"),
+                indices=sample_idxs,
+            )
+            col = f"classification_metrics_{metric}"
+            if col not in per_sample_metrics:
+                col = metric
+            interval = bootstrap_interval(
+                per_sample_metrics[col], seed=job_kwargs.get("seed", 17)
+            )
+            # a NaN width means all values are identical
+            width = np.nan_to_num(interval.get("high", 0) - interval.get("low", 0))
+            if width <= ci_width:
+                logger.info(
+                    f"Stopping {job_kwargs['run_id']} after {n_done[job_idx]}"
+                    f" samples ({metric} interval width: {width:.3f})"
+                )
+                del n_done[job_idx]
+    return job_samples
+
+
+def _get_baseline_samples(job_samples, n_baseline, seed=17):
+    # The same random samples for every job, among those it evaluated
+    order = list(range(max(len(sample_idxs) for sample_idxs in job_samples)))
+    random.Random(seed).shuffle(order)
+    baseline_samples = []
+    for sample_idxs in job_samples:
+        sample_idxs = set(sample_idxs)
+        baseline_samples.append(
+            sorted([idx for idx in order if idx in sample_idxs][:n_baseline])
+        )
+    return baseline_samples
+
+
+def _get_cascade_stats(
+    jobs,
+    job_samples,
+    stages,
+    n_samples,
+    cheap_time,
+    llm_time,
+    baseline=None,
+):
+    # Per-stage accuracy and routing rate of each job, plus the end-to-end
+    # throughput compared with sending every sample to the LLM. `baseline`
+    # has the LLM predictions of every sample of a subset (job_samples,
+    # predictions, n_llm, time), to compare the cascade with an all-LLM run.
+    n_items = sum(len(sample_idxs) for sample_idxs in job_samples)
+    n_llm = 0
+    job_stats = []
+    for job_idx, ((_, result), sample_idxs) in enumerate(zip(jobs, job_samples)):
+        job_stages = [stages[job_idx * n_samples + idx] for idx in sample_idxs]
+        correct = [
+            str(p) == str(r)
+            for p, r in zip(result["predictions"], result["references"])
+        ]
+        stats = {}
+        for stage in ["cheap", "llm"]:
+            stage_correct = [c for c, s in zip(correct, job_stages) if s == stage]
+            stats[stage] = dict(
+                n_samples=len(stage_correct),
+                accuracy=float(np.mean(stage_correct)) if stage_correct else None,
+            )
+        stats["routing_rate"] = stats["llm"]["n_samples"] / max(len(job_stages), 1)
+        n_llm += stats["llm"]["n_samples"]
+
+        if baseline is not None:
+            positions = {idx: pos for pos, idx in enumerate(sample_idxs)}
+            baseline_positions = [positions[idx] for idx in baseline[0][job_idx]]
+            llm_correct = [
+                str(p) == str(result["references"][pos])
+                for p, pos in zip(baseline[1][job_idx], baseline_positions)
+            ]
+            cascade_correct = [correct[pos] for pos in baseline_positions]
+            stats["all_llm"] = dict(n_samples=len(llm_correct))
+            if llm_correct:
+                stats["all_llm"].update(
+                    accuracy=float(np.mean(llm_correct)),
+                    cascade_accuracy=float(np.mean(cascade_correct)),
+                    accuracy_delta=float(
+                        np.mean(cascade_correct) - np.mean(llm_correct)
+                    ),
+                )
+        job_stats.append(stats)
+
+    total_time = cheap_time + llm_time
+    # the LLM rate also counts the samples of the all-LLM baseline
+    n_llm_calls, llm_calls_time = n_llm, llm_time
+    if baseline is not None:
+        n_llm_calls += baseline[2]
+        llm_calls_time += baseline[3]
+    throughput = dict(
+        samples_per_second=n_items / max(total_time, 1e-9),
+        llm_samples_per_second=(
+            n_llm_calls / max(llm_calls_time, 1e-9) if n_llm_calls else None
+        ),
+    )
+    if n_llm_calls:
+        # time to send every sample to the LLM at the measured LLM rate
+        baseline_time = n_items * llm_calls_time / n_llm_calls
+        throughput["speedup"] = baseline_time / max(total_time, 1e-9)
+    logger.info(f"Cascade routed {n_llm} of {n_items} samples to the LLM: {throughput}")
+    for stats in job_stats:
+        stats["throughput"] = throughput
+        if "accuracy_delta" in stats.get("all_llm", {}):
+            logger.info(f"Cascade accuracy compared with the LLM: {stats['all_llm']}")
+    return job_stats
+
+
+def evaluate_classifier_batched(
+    jobs,
+    batch_size=8,
+    max_batch_tokens=None,
+    classifier=None,
+    prediction_cache=None,
+    checkpoint=None,
+    early_stopping=None,
+    cascade=None,
+    stratified_bootstrap=False,
+    timer=None,
+    on_result=None,
+):
+    # Runs all (label permutation, sample) pairs of a sweep as one workload.
+    # `jobs` is a list of (evaluate_classifier kwargs, result dict) pairs and
+    # the result dicts are filled in place. `on_result(job_idx)` is called
+    # once the result of a job is saved.
+    kwargs = jobs[0][0]
+    model_name = kwargs["model_name"]
+    run_ids = [job_kwargs["run_id"] for job_kwargs, _ in jobs]
+    if timer is None:
+        timer = StageTimer()
+    with timer.stage("load_samples"):
+        sources, references = load_samples(
+            kwargs["dataset_name"],
+            kwargs.get("source_key", "text"),
+            kwargs["target_key"],
+            preprocess_fn=kwargs.get("preprocess_fn"),
+            max_samples=kwargs.get("max_samples"),
+            shuffle=kwargs.get("shuffle", False),
+            seed=kwargs.get("seed", 17),
+            streaming=kwargs.get("streaming", False),
+            balanced=kwargs.get("balanced", False),
+        )
+    if classifier is None:
+        with timer.stage("model_load"):
+            classifier = get_classifier(
+                model_name,
+                ignore_errors=kwargs.get("ignore_errors", False),
+                seed=kwargs.get("seed", 17),
+                **get_model_kwargs(kwargs),
+            )
+
+    items = [
+        dict(
+            context_prompt=job_kwargs["model_context_prompt"],
+            input=source,
+            labels=job_kwargs["model_labels"],
+            label_type=job_kwargs["model_label_type"],
+            noisy_channel=job_kwargs.get("model_noisy_channel", False),
+        )
+        for job_kwargs, _ in jobs
+        for source in sources
+    ]
+    logger.info(
+        f"Evaluating {model_name} on {len(sources)} samples"
+        f" x {len(jobs)} label permutations."
+    )
+    with timer.stage("tokenization", samples=len(items)):
+        prompts = [classifier.build_prompt(x) for x in items]
+        lengths = classifier.count_tokens(prompts)
+    timer.add("tokenization", prompt_tokens=int(np.sum(lengths)))
+    n_samples = len(sources)
+    logger.info(
+        f"Processing {len(items)} prompts (mean tokens: {np.mean(lengths):.1f})"
+    )
+
+    close_cache = isinstance(prediction_cache, (str, Path))
+    if close_cache:
+        prediction_cache = PredictionCache(prediction_cache)
+
+    keys = _get_cache_keys(classifier, items)
+    outputs = [None] * len(items)
+    if checkpoint is not None:
+        outputs = [checkpoint.get(key) for key in keys]
+        n_done = sum(o is not None for o in outputs)
+        logger.info(f"Resuming with {n_done} of {len(items)} prompts done")
+
+    def run_items(idxs):
+        batches = _get_item_batches(
+            classifier, idxs, lengths, n_samples, batch_size, max_batch_tokens
+        )
+        for batch in batches:
+            # samples finished before an interruption are skipped
+            batch = [idx for idx in batch if outputs[idx] is None]
+            if not batch:
+                continue
+            batch_items = [items[idx] for idx in batch]
+            batch_keys = [keys[idx] for idx in batch]
+            wall, cpu = time.perf_counter(), time.process_time()
+            batch_outputs = _get_outputs(
+                classifier, batch_items, batch_keys, prediction_cache
+            )
+            _add_batch_timings(
+                timer,
+                classifier,
+                [run_ids[idx // n_samples] for idx in batch],
+                [lengths[idx] for idx in batch],
+                batch_outputs,
+                time.perf_counter() - wall,
+                time.process_time() - cpu,
+            )
+            for idx, output in zip(batch, batch_outputs):
+                outputs[idx] = output
+            if checkpoint is not None:
+                checkpoint.update(
+                    {k: o for k, o in zip(batch_keys, batch_outputs) if o is not None}
+                )
+
+    stages = None
+    start = time.monotonic()
+    if cascade is not None:
+        # confident samples are answered by the cheap stage, the rest go to
+        # the model. Jobs with cascade=False (e.g. those measuring guideline
+        # effects) are only answered by the model.
+        stages = []
+        for idx, label_scores in enumerate(cascade.score(items)):
+            stage = "llm"
+            if (
+                outputs[idx] is None
+                and jobs[idx // n_samples][0].get("cascade", True)
+                and cascade.is_confident(label_scores)
+            ):
+                outputs[idx] = label_scores
+                stage = "cheap"
+            stages.append(stage)
+    cheap_time = time.monotonic() - start
+    if cascade is not None:
+        timer.add("cascade", wall=cheap_time, calls=1, samples=len(items))
+
+    job_samples = [list(range(n_samples))] * len(jobs)
+    if early_stopping is None:
+        run_items(list(range(len(items))))
+    else:
+        job_samples = _run_early_stopping(
+            jobs, items, outputs, sources, references, run_items, **early_stopping
+        )
+    llm_time = time.monotonic() - start - cheap_time
+
+    baseline = None
+    if cascade is not None and cascade.baseline_samples:
+        # all-LLM reference on a subset: the cheap-stage samples of the subset
+        # are also sent to the model, without changing the results
+        start = time.monotonic()
+        baseline_samples = _get_baseline_samples(
+            job_samples, cascade.baseline_samples, seed=kwargs.get("seed", 17)
+        )
+        baseline_idxs = [
+            job_idx * n_samples + idx
+            for job_idx, sample_idxs in enumerate(baseline_samples)
+            for idx in sample_idxs
+        ]
+        missing = [idx for idx in baseline_idxs if stages[idx] == "cheap"]
+        baseline_outputs = {}
+        batches = _get_item_batches(
+            classifier, missing, lengths, n_samples, batch_size, max_batch_tokens
+        )
+        for batch in batches:
+            batch_outputs = _get_outputs(
+                classifier,
+                [items[idx] for idx in batch],
+                [keys[idx] for idx in batch],
+                prediction_cache,
+            )
+            baseline_outputs.update(zip(batch, batch_outputs))
+        baseline_predictions = [
+            [
+                parse_output(
+                    baseline_outputs.get(offset + idx, outputs[offset + idx]),
+                    items[offset]["labels"],
+                )
+                for idx in sample_idxs
+            ]
+            for offset, sample_idxs in zip(
+                range(0, len(items), n_samples), baseline_samples
+            )
+        ]
+        baseline_time = time.monotonic() - start
+        timer.add("cascade_baseline", wall=baseline_time, samples=len(missing))
+        baseline = (baseline_samples, baseline_predictions, len(missing), baseline_time)
+
+    if prediction_cache is not None:
+        prediction_cache.report()
+    if close_cache:
+        prediction_cache.close()
+
+    for job_idx, (_, result) in enumerate(jobs):
+        _set_job_result(
+            result, job_idx, job_samples[job_idx], items, outputs, references
+        )
+
+    if stages is not None:
+        cascade_stats = _get_cascade_stats(
+            jobs, job_samples, stages, n_samples, cheap_time, llm_time, baseline
+        )
+        for job_idx, ((_, result), stats) in enumerate(zip(jobs, cascade_stats)):
+            result["cascade"] = stats
+            result["stages"] = [
+                stages[job_idx * n_samples + idx] for idx in job_samples[job_idx]
+            ]
+            # TF-IDF probabilities are not model label scores
+            if "cheap" in result["stages"]:
+                result.pop("label_scores", None)
+
+    # bootstrap resamples are shared by all permutations evaluated in full
+    seed = kwargs.get("seed", 17)
+    strata = references if stratified_bootstrap else None
+    counts = get_resample_counts(n_samples, seed=seed, strata=strata)
+
+    # metrics are computed once all predictions are available, since
+    # guideline effects compare each permutation with the factual run
+    for job_idx, ((job_kwargs, result), sample_idxs) in enumerate(
+        zip(jobs, job_samples)
+    ):
+        run_id = job_kwargs["run_id"]
+        with timer.stage("metrics", key=run_id, samples=len(sample_idxs)):
+            per_sample_metrics = _get_per_sample_metrics(
+                result["predictions"],
+                result["references"],
+                [sources[idx] for idx in sample_idxs],
+                metrics=job_kwargs.get("metrics"),
+                indices=sample_idxs,
+            )
+            result["agg_scores"] = aggregate_metrics(
+                per_sample_metrics,
+                seed=seed,
+                counts=counts if len(sample_idxs) == n_samples else None,
+                strata=result["references"] if stratified_bootstrap else None,
+            )
+        with timer.stage("save", key=run_id):
+            save_result(result, job_kwargs, per_sample_metrics)
+        if on_result is not None:
+            on_result(job_idx)
+
+    return [result for _, result in jobs]
@@ -0,0 +1,131 @@
+from functools import lru_cache
+
+import numpy as np
+
+# groups of nested classification metrics in the JSON files written by llms
+METRIC_GROUPS = ["source_stats", "prediction_stats", "reference_stats", "length_diff"]
+
+
+@lru_cache(maxsize=100000)
+def get_text_stats(text):
+    # Length and readability statistics of a text, as in the source,
+    # prediction and reference stats of llms. Cached since the sources and
+    # references are the same for every permutation of a sweep.
+    import nltk
+    import textstat
+
+    sentences = nltk.sent_tokenize(text)
+    n_tokens = sum(len(nltk.word_tokenize(s)) for s in sentences)
+    return dict(
+        sentences_per_sample=len(sentences),
+        tokens_per_sentence=n_tokens / len(sentences) if sentences else np.nan,
+        tokens_per_sample=n_tokens,
+        fkgl_readability=textstat.flesch_kincaid_grade(text),
+    )
+
+
+def get_length_diff(prediction_stats, reference_stats):
+    return dict(
+        sentences_diff=abs(
+            prediction_stats["sentences_per_sample"]
+            - reference_stats["sentences_per_sample"]
+        ),
+        tokens_diff=abs(
+            prediction_stats["tokens_per_sample"] - reference_stats["tokens_per_sample"]
+        ),
+    )
+
+
+def get_resample_counts(n_samples, n_resamples=1000, seed=17, strata=None):
+    # How many times each sample is drawn in each bootstrap resample, as an
+    # (n_resamples, n_samples) matrix. With `strata` (e.g. the reference
+    # labels), every class is resampled separately and keeps its size.
+    rng = np.random.default_rng(seed)
+    if strata is None:
+        draws = rng.integers(0, n_samples, size=(n_resamples, n_samples))
+        groups = [(np.arange(n_samples), draws)]
+    else:
+        strata = np.asarray([str(x) for x in strata])
+        groups = []
+        for stratum in np.unique(strata):
+            members = np.flatnonzero(strata == stratum)
+            draws = rng.integers(0, len(members), size=(n_resamples, len(members)))
+            groups.append((members, draws))
+
+    counts = np.zeros(n_resamples * n_samples, dtype=np.int64)
+    offsets = np.arange(n_resamples)[:, None] * n_samples
+    for members, draws in groups:
+        counts += np.bincount(
+            (offsets + members[draws]).ravel(), minlength=n_resamples * n_samples
+        )
+    return counts.reshape(n_resamples, n_samples)
+
+
+def bootstrap_intervals(values, counts=None, confidence=0.95, seed=17, strata=None):
+    # Bootstrap intervals for every column of an (n_samples, n_metrics) array,
+    # with all metrics evaluated on the same resamples. Missing values are
+    # left out of the resampled means.
+    values = np.asarray(values, dtype=float)
+    if counts is None:
+        counts = get_resample_counts(len(values), seed=seed, strata=strata)
+    is_valid = ~np.isnan(values)
+    sums = counts @ np.where(is_valid, values, 0)
+    sizes = counts @ is_valid
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / sizes
+    alpha = (1 - confidence) / 2
+
+    intervals = []
+    for col in range(values.shape[1]):
+        col_values = values[is_valid[:, col], col]
+        if len(col_values) == 0:
+            intervals.append({"mean": np.nan})
+            continue
+        mean = col_values.mean()
+        if len(col_values) == 1:
+            intervals.append({"mean": mean})
+        elif np.all(col_values == col_values[0]):
+            intervals.append({"low": np.nan, "high": np.nan, "mean": mean})
+        else:
+            low, high = np.nanquantile(means[:, col], [alpha, 1 - alpha])
+            intervals.append({"low": low, "high": high, "mean": mean})
+    return intervals
+
+
+def bootstrap_interval(values, confidence=0.95, seed=17, strata=None):
+    values = np.asarray(values, dtype=float)[:, None]
+    intervals = bootstrap_intervals(
+        values, confidence=confidence, seed=seed, strata=strata
+    )
+    return intervals[0]
+
+
+def _get_metric_path(col):
+    # "classification_metrics_source_stats_tokens_per_sample" ->
+    # ["classification_metrics", "source_stats", "tokens_per_sample"]
+    prefix = "classification_metrics_"
+    if not col.startswith(prefix):
+        return [None, col]
+    name = col[len(prefix) :]
+    for group in METRIC_GROUPS:
+        if name.startswith(f"{group}_"):
+            return ["classification_metrics", group, name[len(group) + 1 :]]
+    return ["classification_metrics", name]
+
+
+def aggregate_metrics(per_sample_metrics, seed=17, counts=None, strata=None):
+    # Bootstrap intervals for every column of a per-sample metrics table,
+    # nested like the JSON files written by llms (metrics without the
+    # "classification_metrics_" prefix go under None). `counts` can be shared
+    # by runs over the same samples.
+    intervals = bootstrap_intervals(
+        per_sample_metrics.values, counts=counts, seed=seed, strata=strata
+    )
+    agg_scores = {}
+    for col, interval in zip(per_sample_metrics.columns, intervals):
+        *groups, name = _get_metric_path(col)
+        scores = agg_scores
+        for group in groups:
+            scores = scores.setdefault(group, {})
+        scores[name] = interval
+    return agg_scores
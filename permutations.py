@@ -0,0 +1,294 @@
+import hashlib
+from array import array
+from functools import partial
+import json
+import math
+from pathlib import Path
+import threading
+
+import numpy as np
+
+SIMILARITY_CACHE_DIR = Path(".cache") / "similarity"
+
+_SHUFFLE_CACHE = {}
+_SHUFFLE_CACHE_SIZE = 4
+# shared by the config threads of a sweep
+_SHUFFLE_CACHE_LOCK = threading.Lock()
+# Replaying the shuffle of all n! orders takes n! generator draws for each new
+# generator state: milliseconds up to 8 items, but seconds and hundreds of MB
+# from 10 items. Paths that share one generator across iterations (all label
+# noise types except "random") get a new state every time. The "shuffle"
+# order reproduces the permutations of earlier runs and is the default; the
+# "auto" order switches to the (different) feistel order above this size.
+SHUFFLE_MAX_ITEMS = 8
+
+_SIMILARITY_CACHE = {}
+
+
+def unrank_permutation(items, rank):
+    # Lehmer decoding of `rank` in the order produced by itertools.permutations
+    items = list(items)
+    permutation = []
+    for ii in range(len(items), 0, -1):
+        index, rank = divmod(rank, math.factorial(ii - 1))
+        permutation.append(items.pop(index))
+    return permutation
+
+
+def _get_shuffle_draws(n_items, random_):
+    # Replays random.Random.shuffle on a list of `n_items` elements, keeping
+    # only the swap positions. The generator ends up in the same state as after
+    # the original shuffle, and repeated calls with the same state are cached.
+    state = random_.getstate()
+    cache_key = (n_items, hashlib.sha1(repr(state).encode()).hexdigest())
+    with _SHUFFLE_CACHE_LOCK:
+        cached = _SHUFFLE_CACHE.get(cache_key)
+
+    if cached is None:
+        randbelow = random_._randbelow
+        draws = array("q", [0])
+        for ii in range(n_items - 1, 0, -1):
+            draws.append(randbelow(ii + 1))
+        # draws were generated from the last position to the first
+        draws = np.frombuffer(draws, dtype=np.int64)
+        draws = np.concatenate([draws[:1], draws[:0:-1]])
+        # steps grouped by swap position, for fast "next swap touching p" lookups
+        steps = np.argsort(draws, kind="stable")
+        cached = draws, draws[steps], steps, random_.getstate()
+
+        with _SHUFFLE_CACHE_LOCK:
+            if len(_SHUFFLE_CACHE) >= _SHUFFLE_CACHE_SIZE:
+                _SHUFFLE_CACHE.pop(next(iter(_SHUFFLE_CACHE)))
+            _SHUFFLE_CACHE[cache_key] = cached
+    else:
+        random_.setstate(cached[-1])
+
+    return cached[:-1]
+
+
+def _trace_shuffled_rank(draws, sorted_draws, steps, index):
+    # Position `index` is final after the swap at step `index`, so we trace
+    # its value back through the later swaps
+    n_items = len(draws)
+    if index == 0:
+        position, start = 0, 1
+    else:
+        position, start = int(draws[index]), index + 1
+
+    while start < n_items:
+        lo = np.searchsorted(sorted_draws, position, side="left")
+        hi = np.searchsorted(sorted_draws, position, side="right")
+        position_steps = steps[lo:hi]
+        next_idx = np.searchsorted(position_steps, start)
+        if next_idx == len(position_steps):
+            break
+        position = int(position_steps[next_idx])
+        start = position + 1
+    return position
+
+
+def shuffled_permutation_rank(n_items, index, random_):
+    # Equivalent to `x = list(range(n_items)); random_.shuffle(x); x[index]`
+    # without materializing `x`
+    return _trace_shuffled_rank(*_get_shuffle_draws(n_items, random_), index)
+
+
+def _feistel_round(value, key, round_idx, mask):
+    digest = hashlib.blake2b(
+        f"{key}:{round_idx}:{value}".encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big") & mask
+
+
+def feistel_permutation_rank(n_items, index, key, rounds=4):
+    # Keyed bijection on range(n_items) (Feistel network with cycle walking),
+    # O(1) memory and independent of n_items for each lookup.
+    half_bits = max(1, ((n_items - 1).bit_length() + 1) // 2)
+    mask = (1 << half_bits) - 1
+    value = index
+    while True:
+        left, right = value >> half_bits, value & mask
+        for round_idx in range(rounds):
+            left, right = right, left ^ _feistel_round(right, key, round_idx, mask)
+        value = (left << half_bits) | right
+        if value < n_items:
+            return value
+
+
+def get_shuffled_permutations(items, random_, permutation_idxs, order="shuffle"):
+    # Permutations at several indices of the same seeded order, i.e. what
+    # get_shuffled_permutation returns for each index from a generator in the
+    # same state. The generator is advanced once.
+    items = list(items)
+    n_permutations = math.factorial(len(items))
+    if order == "auto":
+        order = "shuffle" if len(items) <= SHUFFLE_MAX_ITEMS else "feistel"
+
+    if order == "shuffle":
+        draws = _get_shuffle_draws(n_permutations, random_)
+        get_rank = partial(_trace_shuffled_rank, *draws)
+    elif order == "feistel":
+        key = random_.getrandbits(64)
+        get_rank = partial(feistel_permutation_rank, n_permutations, key=key)
+    else:
+        raise ValueError(f"Unsupported permutation order: {order}")
+
+    return [
+        unrank_permutation(items, get_rank(idx)) if idx < n_permutations else None
+        for idx in permutation_idxs
+    ]
+
+
+def get_shuffled_permutation(items, random_, permutation_idx, order="shuffle"):
+    items = list(items)
+    if permutation_idx >= math.factorial(len(items)):
+        return None
+    return get_shuffled_permutations(items, random_, [permutation_idx], order)[0]
+
+
+def count_derangements(n_items):
+    count, previous = 1, 0
+    for ii in range(1, n_items + 1):
+        count, previous = (ii - 1) * (count + previous), count
+    return count
+
+
+def count_permutations_with_fixed_points(n_items, n_fixed):
+    # rencontres number D(n, k)
+    if n_fixed > n_items:
+        return 0
+    return math.comb(n_items, n_fixed) * count_derangements(n_items - n_fixed)
+
+
+def sample_permutation_with_fixed_points(n_items, n_fixed, random_):
+    if count_permutations_with_fixed_points(n_items, n_fixed) == 0:
+        raise ValueError(
+            f"There is no permutation of {n_items} items with {n_fixed} fixed points"
+        )
+    fixed = set(random_.sample(range(n_items), n_fixed))
+    moved = [ii for ii in range(n_items) if ii not in fixed]
+
+    # uniform derangement of the moved items (accepted with probability ~1/e)
+    deranged = list(moved)
+    while len(moved) and any(a == b for a, b in zip(moved, deranged)):
+        random_.shuffle(deranged)
+
+    permutation = list(range(n_items))
+    for position, item in zip(moved, deranged):
+        permutation[position] = item
+    return permutation
+
+
+def plan_permutations_by_distance(
+    n_items, n_permutations, n_permutations_per_distance, random_, logger=None
+):
+    # Distinct permutations per number of fixed points (i.e., per edit distance),
+    # allocated round-robin from the most to the least perturbed bucket.
+    capacities = {
+        n_fixed: min(
+            n_permutations_per_distance,
+            count_permutations_with_fixed_points(n_items, n_fixed),
+        )
+        for n_fixed in range(n_items + 1)
+    }
+    allocation = {n_fixed: 0 for n_fixed in capacities}
+    n_planned = 0
+    while n_planned < n_permutations:
+        added = 0
+        for n_fixed, capacity in capacities.items():
+            if allocation[n_fixed] < capacity and n_planned < n_permutations:
+                allocation[n_fixed] += 1
+                n_planned += 1
+                added += 1
+        if added == 0:
+            break
+
+    if logger and n_planned < n_permutations:
+        logger.warning(
+            f"Only {n_planned} of {n_permutations} permutations are available"
+            f" with at most {n_permutations_per_distance} per distance"
+        )
+
+    permutations = []
+    for n_fixed, count in allocation.items():
+        sampled = set()
+        while len(sampled) < count:
+            permutation = sample_permutation_with_fixed_points(
+                n_items, n_fixed, random_
+            )
+            sampled.add(tuple(permutation))
+        permutations.extend(sorted(sampled))
+    random_.shuffle(permutations)
+    return permutations
+
+
+def plan_label_permutations(
+    labels, n_permutations, n_permutations_per_distance, random_, logger=None
+):
+    labels = list(labels)
+    permutations = plan_permutations_by_distance(
+        len(labels),
+        n_permutations,
+        n_permutations_per_distance,
+        random_,
+        logger=logger,
+    )
+    return [{labels[ii]: v for ii, v in zip(perm, labels)} for perm in permutations]
+
+
+def _compute_similarity_matrix(definitions, labels, metric):
+    if metric is None or metric == "edit":
+        return np.eye(len(labels))
+
+    from llms.metrics import rouge_score
+
+    matrix = np.zeros((len(labels), len(labels)))
+    for ii, label_a in enumerate(labels):
+        for jj, label_b in enumerate(labels):
+            score = rouge_score(
+                definitions[label_a], definitions[label_b], rouge_ngrams=[metric]
+            )
+            matrix[ii, jj] = score[metric].fmeasure
+    return matrix
+
+
+def get_similarity_matrix(definitions, metric, cache_dir=SIMILARITY_CACHE_DIR):
+    # Label x label similarity between definitions, cached in memory and on
+    # disk under a hash of the definitions.
+    labels = sorted(definitions)
+    definitions_str = json.dumps([[l, definitions[l]] for l in labels])
+    definitions_hash = hashlib.sha1(definitions_str.encode()).hexdigest()
+    cache_key = (metric, definitions_hash)
+
+    if cache_key not in _SIMILARITY_CACHE:
+        cache_path = None
+        if cache_dir and metric not in [None, "edit"]:
+            cache_path = Path(cache_dir) / f"{metric}_{definitions_hash}.json"
+
+        if cache_path and cache_path.exists():
+            with open(cache_path) as f:
+                matrix = np.array(json.load(f)["matrix"])
+        else:
+            matrix = _compute_similarity_matrix(definitions, labels, metric)
+            if cache_path:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(cache_path, "w") as f:
+                    json.dump(dict(labels=labels, matrix=matrix.tolist()), f)
+
+        label_index = {l: ii for ii, l in enumerate(labels)}
+        _SIMILARITY_CACHE[cache_key] = label_index, matrix
+
+    return _SIMILARITY_CACHE[cache_key]
+
+
+def get_permutation_similarities(
+    label_permutations, definitions, metric, cache_dir=SIMILARITY_CACHE_DIR
+):
+    # Mean similarity between each permuted label and its original definition,
+    # for a batch of permutations over the same labels.
+    label_index, matrix = get_similarity_matrix(
+        definitions, metric, cache_dir=cache_dir
+    )
+    rows = np.array([[label_index[k] for k in p] for p in label_permutations])
+    cols = np.array([[label_index[v] for v in p.values()] for p in label_permutations])
+    return matrix[rows, cols].mean(axis=1)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+PREDICTION_CACHE_PATH = Path(".cache") / "predictions.sqlite"
+
+
+def get_cache_key(model_name, context_prompt, input, generation_kwargs):
+    fields = dict(
+        model_name=model_name,
+        context_prompt=context_prompt,
+        input=input,
+        generation_kwargs=generation_kwargs,
+    )
+    fields = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(fields.encode()).hexdigest()
+
+
+class PredictionCache:
+    # Model outputs in a single SQLite file, shared by runs and processes.
+    # WAL mode lets readers proceed during writes, and the least recently used
+    # entries are evicted once the cache exceeds `max_size_mb`, checked every
+    # `evict_every` inserts and when the cache is closed.
+    def __init__(
+        self,
+        path=PREDICTION_CACHE_PATH,
+        max_size_mb=1024,
+        timeout=60,
+        evict_every=1000,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.evict_every = evict_every
+        self._n_inserted = 0
+        self.stats = dict(hits=0, misses=0, evicted=0)
+        self.connection = sqlite3.connect(
+            self.path, timeout=timeout, isolation_level=None
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed_at REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS predictions_accessed_at"
+            " ON predictions (accessed_at)"
+        )
+
+    def get_many(self, keys):
+        values = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, value FROM predictions WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            values.update({key: json.loads(value) for key, value in rows})
+
+        if values:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE predictions SET accessed_at = ? WHERE key = ?",
+                [(now, key) for key in values],
+            )
+        self.stats["hits"] += len(values)
+        self.stats["misses"] += len(set(keys)) - len(values)
+        return values
+
+    def set_many(self, values):
+        now = time.time()
+        rows = []
+        for key, value in values.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value) + len(key), now))
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)", rows
+            )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        # a long or interrupted sweep does not wait for close() to evict
+        self._n_inserted += len(rows)
+        if self.evict_every and self._n_inserted >= self.evict_every:
+            self.evict()
+
+    def evict(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            total_size = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM predictions"
+            ).fetchone()[0]
+            evicted = 0
+            rows = self.connection.execute(
+                "SELECT key, size FROM predictions ORDER BY accessed_at"
+            )
+            to_delete = []
+            for key, size in rows:
+                if total_size <= self.max_size:
+                    break
+                to_delete.append((key,))
+                total_size -= size
+            if to_delete:
+                self.connection.executemany(
+                    "DELETE FROM predictions WHERE key = ?", to_delete
+                )
+                evicted = len(to_delete)
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.stats["evicted"] += evicted
+        self._n_inserted = 0
+
+    def report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        hit_rate = self.stats["hits"] / lookups if lookups else 0
+        logger.info(
+            f"Prediction cache {self.path}: {self.stats['hits']} hits,"
+            f" {self.stats['misses']} misses ({hit_rate:.1%} hit rate),"
+            f" {self.stats['evicted']} evicted"
+        )
+
+    def close(self):
+        self.evict()
+        self.connection.close()
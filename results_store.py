@@ -0,0 +1,157 @@
+from glob import glob
+import logging
+from pathlib import Path
+import re
+
+import fire
+
+logger = logging.getLogger(__name__)
+
+RESULTS_STORE_PATH = Path("data") / "results_store"
+PARTITION_KEYS = ["model", "domain", "concept", "condition", "permutation"]
+LABEL_NOISE_TYPES = ["random", "nonfactual", "ood"]
+# label noise conditions and joint multi-concept runs (run_multi_concept.py)
+CONDITIONS = LABEL_NOISE_TYPES + ["joint"]
+
+RUN_PATTERN = re.compile(
+    r"^(?P<dataset>.+?)_(?P<timestr>\d{8}-\d{6})_(?P<model>.+)"
+    r"-(?P<domain>financial|scientific)-(?P<rest>.+)$"
+)
+
+
+def get_condition(label_noise=None, empty_definition=False):
+    # Condition of a run, e.g. "ood_empty_def" (run_guidelines.py conditions).
+    # Empty definitions leave no trace in the run directory name.
+    condition = label_noise or "factual"
+    if empty_definition:
+        condition = "empty_def" if label_noise is None else f"{condition}_empty_def"
+    return condition
+
+
+def get_run_keys(run_name):
+    # Partition keys from a run directory name, e.g.
+    # "train_20231011-064601_llama-2-7b-chat-scientific-chatgpt_random-definition_0_of_50".
+    # Runs with empty definitions cannot be told apart by their name, so
+    # evaluate passes their condition to append_run.
+    match = RUN_PATTERN.match(run_name)
+    if match is None:
+        raise ValueError(f"Unrecognized run directory: {run_name}")
+
+    rest = match["rest"]
+    permutation = 0
+    count_match = re.search(r"_(\d+)_of_\d+$", rest)
+    if count_match:
+        permutation = int(count_match[1])
+        rest = rest[: count_match.start()]
+    concept, guidelines = rest.rsplit("_", 1)
+    condition = guidelines.split("-")[0]
+    if condition not in CONDITIONS:
+        condition = "factual"
+
+    return dict(
+        model=match["model"].replace("/", "_"),
+        domain=match["domain"],
+        concept=concept,
+        condition=condition,
+        permutation=str(permutation),
+    )
+
+
+def _write_table(data, path, run_name):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    # one file per run, so importing a run again replaces it
+    pq.write_to_dataset(
+        table,
+        path,
+        partition_cols=PARTITION_KEYS,
+        basename_template=f"{run_name}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def append_run(run_dir, store_path=RESULTS_STORE_PATH, condition=None):
+    # Adds the predictions and per-sample metrics of a run directory to the
+    # store: a "predictions" dataset with one row per sample and a "metrics"
+    # dataset in long format, with one row per non-missing (sample, metric).
+    # `condition` replaces the one parsed from the directory name.
+    import pandas as pd
+
+    run_dir = Path(run_dir)
+    keys = get_run_keys(run_dir.name)
+    if condition is not None:
+        keys["condition"] = condition
+    predictions_path = next(run_dir.glob("*_predictions.csv"), None)
+    metrics_path = next(run_dir.glob("*_metrics_per_sample.csv"), None)
+    if predictions_path is None:
+        logger.warning(f"No predictions found in {run_dir}")
+        return
+
+    predictions = pd.read_csv(predictions_path, keep_default_na=False)
+    predictions = predictions.astype(str)
+    predictions.insert(0, "sample", range(len(predictions)))
+    predictions.insert(0, "run", run_dir.name)
+    for key, value in keys.items():
+        predictions[key] = value
+    _write_table(predictions, Path(store_path) / "predictions", run_dir.name)
+
+    if metrics_path is not None:
+        metrics = pd.read_csv(metrics_path)
+        metrics = metrics.astype(float).rename_axis("sample").reset_index()
+        metrics = metrics.melt(id_vars="sample", var_name="metric").dropna()
+        metrics.insert(0, "run", run_dir.name)
+        for key, value in keys.items():
+            metrics[key] = value
+        _write_table(metrics, Path(store_path) / "metrics", run_dir.name)
+
+
+def import_results(results_dir="data/results", store_path=RESULTS_STORE_PATH):
+    run_dirs = glob(str(Path(results_dir) / "**" / "*_predictions.csv"), recursive=True)
+    run_dirs = sorted(set(Path(p).parent for p in run_dirs))
+    for run_dir in run_dirs:
+        append_run(run_dir, store_path)
+    logger.info(f"Imported {len(run_dirs)} runs from {results_dir} into {store_path}")
+
+
+def _read_dataset(path, columns=None, filters=None, metric_prefix=None):
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    expression = None
+    if filters:
+        expression = pq.filters_to_expression(filters)
+    if metric_prefix:
+        # filtered before conversion to pandas
+        prefix_expression = pc.starts_with(ds.field("metric"), metric_prefix)
+        if expression is None:
+            expression = prefix_expression
+        else:
+            expression = expression & prefix_expression
+    table = dataset.to_table(columns=columns, filter=expression)
+    return table.to_pandas()
+
+
+def load_metrics(
+    store_path=RESULTS_STORE_PATH, columns=None, filters=None, metric_prefix=None
+):
+    return _read_dataset(
+        Path(store_path) / "metrics",
+        columns=columns,
+        filters=filters,
+        metric_prefix=metric_prefix,
+    )
+
+
+def load_predictions(store_path=RESULTS_STORE_PATH, columns=None, filters=None):
+    return _read_dataset(
+        Path(store_path) / "predictions", columns=columns, filters=filters
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(dict(import_results=import_results, append_run=append_run))
@@ -1,19 +1,33 @@
+from concurrent.futures import Future
 import fire
-import itertools
+from functools import partial
+import hashlib
+import json
 import logging
+import math
 from pathlib import Path
 from pprint import pformat
 import random
+import re
+import time
 
-import pandas as pd
-
-from llms.classifiers.evaluation import evaluate_classifier
+import numpy as np
 
+from backends import is_fake_model
+from cascade import TfidfCascade
+from checkpoints import Checkpoint
 from guidelines.financial import GUIDELINES as financial_guidelines
 from guidelines.scientific import GUIDELINES as scientific_guidelines
-
-from llms.metrics import rouge_score
-from llms.utils.utils import config_logging
+from prediction_cache import PREDICTION_CACHE_PATH
+from run_logging import StructuredLog, ThreadLog
+from timings import Profiler, StageTimer
+from permutations import (
+    get_permutation_similarities,
+    get_shuffled_permutation,
+    get_shuffled_permutations,
+    get_similarity_matrix,
+    plan_label_permutations,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -139,22 +153,23 @@ def get_context_prompt(
 
 
 def get_permutation_similarity(label_permutation, definitions, type=None):
-    similarity = 0
-    for label_a, label_b in label_permutation.items():
-        if type and "rouge" in type:
-            score = rouge_score(
-                definitions[label_a], definitions[label_b], rouge_ngrams=[type]
-            )
-            score = score[type].fmeasure
-        else:
-            score = int(label_a == label_b)
-        similarity += score
-    similarity /= len(label_permutation)
-    return similarity
+    if not (type and "rouge" in type):
+        type = "edit"
+    label_index, matrix = get_similarity_matrix(definitions, type)
+    scores = [
+        matrix[label_index[label_a], label_index[label_b]]
+        for label_a, label_b in label_permutation.items()
+    ]
+    return float(sum(scores)) / len(label_permutation)
 
 
 def get_label_permutation(
-    labels, label_noise_type, random_, permutation_idx=0, shuffle=False
+    labels,
+    label_noise_type,
+    random_,
+    permutation_idx=0,
+    shuffle=False,
+    permutation_order="shuffle",
 ):
     label_permutation = {}
     if label_noise_type and label_noise_type == "nonfactual":
@@ -180,13 +195,13 @@ def get_label_permutation(
         label_permutation = {l: l for l in labels}
 
     if shuffle and random_:
-        label_permutations = list(
-            itertools.permutations(list(label_permutation.keys()))
+        shuffled_keys = get_shuffled_permutation(
+            label_permutation.keys(),
+            random_,
+            permutation_idx,
+            order=permutation_order,
         )
-        if permutation_idx < len(label_permutations):
-            random_.shuffle(label_permutations)
-            shuffled_keys = label_permutations[permutation_idx]
-
+        if shuffled_keys is not None:
             if label_noise_type and label_noise_type == "random":
                 values = label_permutation.values()
                 label_permutation = {k: v for k, v in zip(shuffled_keys, values)}
@@ -196,39 +211,55 @@ def get_label_permutation(
     return label_permutation
 
 
-def sample_balanced(sources, targets, max_samples=None, random_state=17, logger=None):
-    def is_empty(x):
-        return x is None or str(x) == "nan"  # or x == 'Other'
+def _take(values, idxs):
+    # pandas Series
+    if hasattr(values, "iloc"):
+        return values.iloc[idxs].tolist()
+    if isinstance(values, np.ndarray):
+        return values[idxs].tolist()
+    return [values[idx] for idx in idxs]
+
 
-    empty_target_idxs = [ii for ii in range(len(targets)) if is_empty(targets[ii])]
-    targets = [targets[ii] for ii in range(len(targets)) if ii not in empty_target_idxs]
-    sources = [sources[ii] for ii in range(len(sources)) if ii not in empty_target_idxs]
+def get_balanced_indices(targets, max_samples=None, random_state=17, logger=None):
+    import pandas as pd
 
-    classes = sorted(set(targets))
-    targets_pd = pd.Series(targets)
+    targets = pd.Series(np.asarray(targets, dtype=object))
+    # same semantics as `x is None or str(x) == "nan"`
+    is_empty = targets.map(lambda x: x is None) | (targets.astype(str) == "nan")
+    kept_idxs = np.flatnonzero(~is_empty.values)
+    targets = targets[~is_empty].reset_index(drop=True)
+
+    class_idxs = targets.groupby(targets, sort=True).indices
 
     if max_samples:
-        max_per_class = max_samples // len(classes)
+        max_per_class = max_samples // len(class_idxs)
     else:
-        max_per_class = targets_pd.value_counts().min()
+        max_per_class = min(len(x) for x in class_idxs.values())
 
     if logger:
         logger.info(
-            f"Sampling balanced data for {len(classes)} classes"
+            f"Sampling balanced data for {len(class_idxs)} classes"
             f" (maximum of {max_per_class} samples per class; seed={random_state})"
         )
     idxs = []
-    for class_ in classes:
-        class_targets = targets_pd[targets_pd == class_]
+    for class_, class_targets in class_idxs.items():
         n_samples = min(len(class_targets), max_per_class)
-        class_samples = class_targets.sample(n_samples, random_state=random_state)
-        idxs.extend(class_samples.index.values.tolist())
+        class_samples = pd.Series(class_targets).sample(
+            n_samples, random_state=random_state
+        )
+        idxs.append(class_samples.values)
         if logger:
             logger.info(f'Added {len(class_samples)} samples for class "{class_}"')
 
-    sources = [sources[idx] for idx in idxs]
-    targets = [targets[idx] for idx in idxs]
-    return sources, targets
+    idxs = np.concatenate(idxs) if idxs else np.array([], dtype=int)
+    return kept_idxs[idxs]
+
+
+def sample_balanced(sources, targets, max_samples=None, random_state=17, logger=None):
+    idxs = get_balanced_indices(
+        targets, max_samples=max_samples, random_state=random_state, logger=logger
+    )
+    return _take(sources, idxs), _take(targets, idxs)
 
 
 def add_permutation_metrics(label_permutation, definitions, metrics):
@@ -244,6 +275,40 @@ def add_permutation_metrics(label_permutation, definitions, metrics):
     return new_metrics
 
 
+def get_next_candidate_idx(
+    labels,
+    definitions,
+    idx,
+    distance_counts,
+    max_per_distance,
+    seed=17,
+    permutation_order="shuffle",
+    chunk_size=1000,
+):
+    # Index of the next "random" permutation candidate whose edit distance
+    # bucket is not full yet. Candidates only depend on their index, so they
+    # are scored in chunks (of up to `chunk_size`) with one gather over the
+    # similarity matrix instead of an add_permutation_metrics call each.
+    labels = list(labels)
+    n_candidates = math.factorial(len(labels))
+    # chunks grow while candidates keep being rejected
+    size = 16
+    while idx < n_candidates:
+        idxs = range(idx, min(idx + size, n_candidates))
+        size = min(2 * size, chunk_size)
+        # same candidates as get_label_permutation(labels, "random", ...)
+        shuffled_keys = get_shuffled_permutations(
+            labels, random.Random(seed), idxs, order=permutation_order
+        )
+        candidates = [dict(zip(keys, labels)) for keys in shuffled_keys]
+        similarities = get_permutation_similarities(candidates, definitions, "edit")
+        for candidate_idx, similarity in zip(idxs, similarities):
+            if distance_counts.get(1 - float(similarity), 0) < max_per_distance:
+                return candidate_idx
+        idx = idxs[-1] + 1
+    return idx
+
+
 def guideline_effect(
     prediction,
     reference=None,
@@ -288,6 +353,166 @@ def guideline_effect(
     return metrics
 
 
+def _encode_guideline_labels(values, labels):
+    # Integer codes of predictions after the out-of-vocabulary handling of
+    # guideline_effect: label indices, then "Motivation" (for "Objective")
+    # and "[OOV_LABEL]" if these are not labels themselves
+    import pandas as pd
+
+    values = np.asarray(values, dtype=object)
+    codes = pd.Index(labels).get_indexer(values)
+    n_labels = len(labels)
+    motivation = labels.index("Motivation") if "Motivation" in labels else n_labels
+    codes[(codes == -1) & (values == "Objective")] = motivation
+    codes[codes == -1] = n_labels + 1
+    return codes
+
+
+def guideline_effect_batch(
+    predictions,
+    label_permutation=None,
+    factual_prediction_fn=None,
+    indices=None,
+    **kwargs,
+):
+    # Same per-sample columns as guideline_effect, for a whole permutation
+    import pandas as pd
+
+    label_permutation = {v: k for k, v in label_permutation.items()}
+    labels = list(label_permutation)
+    n_labels = len(labels)
+    if indices is None:
+        indices = np.arange(len(predictions))
+    factual_codes = _encode_guideline_labels(
+        factual_prediction_fn(np.asarray(indices)), labels
+    )
+    codes = _encode_guideline_labels(predictions, labels)
+
+    special_labels = {"Motivation": n_labels, "[OOV_LABEL]": n_labels + 1}
+    expected_codes = pd.Index(labels).get_indexer(list(label_permutation.values()))
+    expected_codes = np.array(
+        [
+            c if c >= 0 else special_labels.get(k, -1)
+            for c, k in zip(expected_codes, label_permutation.values())
+        ]
+        + [-1, -1]
+    )
+
+    in_labels = factual_codes < n_labels
+    expected = expected_codes[factual_codes]
+    scores = np.where(codes == expected, 1, np.where(codes == factual_codes, 0, -1))
+    has_score = in_labels | (codes == factual_codes)
+    scores = np.where(in_labels, scores, 0)
+
+    def to_column(values, mask):
+        values = np.array(values.tolist(), dtype=object)
+        values[~mask] = None
+        return values.tolist()
+
+    metrics = {}
+    for code, (label, expected_label) in enumerate(label_permutation.items()):
+        mask = in_labels & (factual_codes == code)
+        metrics[f"guideline_match_{label}_{expected_label}"] = to_column(scores, mask)
+    metrics["guideline_match"] = to_column(scores, has_score)
+    return metrics
+
+
+def _get_factual_prediction(factual_result, index):
+    if np.ndim(index):
+        return np.asarray(factual_result["predictions"], dtype=object)[index]
+    return factual_result["predictions"][index]
+
+
+def _get_checkpoint_dir(output_dir, run_id, params):
+    params = json.dumps(params, sort_keys=True, default=str)
+    digest = hashlib.sha256(params.encode()).hexdigest()[:12]
+    run_id = re.sub(r"[^\w.-]", "_", run_id)
+    return Path(output_dir) / "checkpoints" / f"{run_id}_{digest}"
+
+
+def _get_checkpoint_record(state, result):
+    keys = ["output_path", "agg_scores", "predictions", "n_samples"]
+    return dict(state, result={k: result[k] for k in keys if k in result})
+
+
+def _save_checkpoint(checkpoint, key, state, future):
+    if future.exception() is None:
+        checkpoint.update({key: _get_checkpoint_record(state, future.result())})
+
+
+def _evaluate_classifier(log_path=None, **kwargs):
+    # llms (and with it torch and transformers) is loaded on first use
+    from llms.classifiers.evaluation import evaluate_classifier
+
+    if log_path is None:
+        return evaluate_classifier(**kwargs)
+
+    # spawned workers do not inherit the logging configuration of the sweep
+    run_log = ThreadLog()
+    run_log.open(log_path)
+    try:
+        return evaluate_classifier(**kwargs)
+    finally:
+        run_log.close()
+
+
+def _get_log_path(run_id, timestr, suffix, **kwargs):
+    from engine import get_output_dir
+
+    dataset_name = kwargs.get("dataset_name", "")
+    output_dir = get_output_dir(
+        kwargs.get("output_dir", "output"), dataset_name, timestr, run_id
+    )
+    return output_dir / f"{Path(dataset_name).stem}_{timestr}_log{suffix}"
+
+
+def _config_logging(
+    run_id, structured_log=None, log_kwargs=None, thread_log=None, **kwargs
+):
+    # With structured logging (log_kwargs), one JSON lines log is opened in
+    # the directory of the first run instead of configuring logging again
+    # for every permutation. Configs of a sweep run in threads that share the
+    # root logger, so their text logs are thread logs instead of llms' logging
+    # configuration.
+    if log_kwargs is None and thread_log is None:
+        from llms.utils.utils import config_logging
+
+        return config_logging(run_id=run_id, **kwargs), structured_log
+
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    if log_kwargs is None:
+        thread_log.open(_get_log_path(run_id, timestr, ".txt", **kwargs))
+    elif structured_log is None:
+        log_path = _get_log_path(run_id, timestr, ".jsonl", **kwargs)
+        structured_log = StructuredLog(log_path, **log_kwargs)
+    return timestr, structured_log
+
+
+def _save_batched_checkpoint(checkpoint, batched_states, job_idx):
+    key, state, result = batched_states[job_idx]
+    checkpoint.update({key: _get_checkpoint_record(state, result)})
+
+
+def _add_future_timings(timer, run_id, start, future):
+    # wall time from submission, including the time spent in the queue
+    wall = time.perf_counter() - start
+    timer.add("evaluate_classifier", key=run_id, wall=wall, calls=1)
+
+
+def _check_resumed_state(record, state):
+    # The permutation RNG sequence is order-dependent, so a resumed run must
+    # replay exactly the state recorded before the interruption
+    state = json.loads(json.dumps(state))
+    for key, value in state.items():
+        if key in ["run_id", "timestr"]:
+            continue
+        if record.get(key) != value:
+            raise ValueError(
+                f"Checkpoint does not match the resumed run ({key} differs)."
+                " Were the evaluation parameters changed?"
+            )
+
+
 def evaluate(
     concept="capital",
     domain="financial",
@@ -298,16 +523,43 @@ def evaluate(
     balanced=False,
     empty_definition=False,
     n_permutations_per_distance=None,
+    stratified_permutations=False,
     add_task_prompt=True,
     label_type=None,
     measure_guideline_effect=False,
     shuffle_guidelines=False,
+    permutation_order="shuffle",
+    batch_permutations=False,
+    permutation_batch_size=8,
+    max_batch_tokens=None,
+    prediction_cache_path=None,
+    early_stopping_ci_width=None,
+    early_stopping_chunk_size=50,
+    early_stopping_min_samples=100,
+    early_stopping_metric="exact_match",
+    cascade_threshold=None,
+    cascade_temperature=0.05,
+    cascade_baseline_samples=None,
+    cascade_guideline_effect=False,
+    stratified_bootstrap=False,
+    results_store=None,
+    streaming=False,
+    profile=None,
+    log_format="text",
+    log_sample_rate=0.01,
+    log_sample_first_n=5,
+    log_compression="auto",
+    classifier=None,
+    executor=None,
+    resume=None,
     run_id=None,
     model_name=None,
     source_key="text",
     seed=17,
     **kwargs,
 ):
+    import pandas as pd
+
     random_ = random.Random(seed)
     concept_guidelines = GUIDELINES[domain][concept]
     guideline_keys = guidelines
@@ -324,6 +576,7 @@ def evaluate(
         empty_definition=empty_definition,
         examples_per_label=examples_per_label,
         n_permutations=n_permutations,
+        stratified_permutations=stratified_permutations,
         add_task_prompt=add_task_prompt,
         add_previous_text=add_previous_text,
         balanced=balanced,
@@ -338,31 +591,107 @@ def evaluate(
         labels = {l: l for l in labels}
 
     preprocess_fn = None
-    if balanced:
-        preprocess_fn = lambda sources, targets, **kwargs: sample_balanced(
-            sources, targets, random_state=seed, **kwargs
-        )
+    if streaming:
+        # the local engine samples while reading the dataset in chunks
+        kwargs.update(streaming=True, balanced=balanced)
+    elif balanced:
+        preprocess_fn = partial(sample_balanced, random_state=seed)
 
     target_key = kwargs.pop("target_key", concept)
-    accuracies = []
-    output_path = None
+    if isinstance(resume, (str, Path)):
+        kwargs["output_dir"] = str(resume)
+
+    early_stopping = None
+    if early_stopping_ci_width:
+        early_stopping = dict(
+            ci_width=early_stopping_ci_width,
+            chunk_size=early_stopping_chunk_size,
+            min_samples=early_stopping_min_samples,
+            metric=early_stopping_metric,
+        )
+    cascade = None
+    if cascade_threshold:
+        cascade = TfidfCascade(
+            cascade_threshold, cascade_temperature, cascade_baseline_samples
+        )
+        if measure_guideline_effect and not cascade_guideline_effect:
+            logger.warning(
+                "The cascade does not answer runs that measure guideline effects."
+                " Use --cascade_guideline_effect to enable it for them."
+            )
+
+    checkpoint_dir = _get_checkpoint_dir(
+        kwargs.get("output_dir", "output"),
+        _get_run_id(model_name, domain, concept, guideline_keys, label_noise, 1, 0),
+        dict(
+            param_dict,
+            model_name=model_name,
+            label_type=label_type,
+            target_key=target_key,
+            n_permutations_per_distance=n_permutations_per_distance,
+            measure_guideline_effect=measure_guideline_effect,
+            shuffle_guidelines=shuffle_guidelines,
+            permutation_order=permutation_order,
+            early_stopping=early_stopping,
+            cascade_threshold=cascade_threshold,
+            cascade_temperature=cascade_temperature,
+            cascade_baseline_samples=cascade_baseline_samples,
+            cascade_guideline_effect=cascade_guideline_effect,
+            stratified_bootstrap=stratified_bootstrap,
+            **{k: v for k, v in kwargs.items() if k != "output_dir"},
+        ),
+    )
+    checkpoint = Checkpoint(checkpoint_dir / "permutations.jsonl", resume=bool(resume))
+    timer = StageTimer()
+    structured_log = None
+    thread_log = ThreadLog() if executor is not None else None
+    log_kwargs = None
+    if log_format == "jsonl":
+        log_kwargs = dict(
+            sample_rate=log_sample_rate,
+            sample_first_n=log_sample_first_n,
+            compression=log_compression,
+            thread_only=executor is not None,
+        )
+    elif log_format != "text":
+        raise ValueError(f"Unsupported log format: {log_format}")
+    profiler = None
+    if profile:
+        profiler = Profiler(profile)
+        profiler.start(checkpoint_dir)
+
+    batched_states = []
+    results = []
+    batched_jobs = []
     permutation_metric_counts = {}
     permutation_metrics = {}
     idx = 0
     last_run_count = 0
     factual_result = None
+    planned_permutations = None
+
+    if (
+        stratified_permutations
+        and label_noise == "random"
+        and n_permutations_per_distance
+    ):
+        planned_permutations = plan_label_permutations(
+            labels,
+            n_permutations,
+            n_permutations_per_distance,
+            random.Random(seed),
+            logger=logger,
+        )
 
-    while len(accuracies) < n_permutations:
+    while len(results) < n_permutations:
         run_factual_guidelines = (
             label_noise in ["random", "nonfactual"]
             and measure_guideline_effect
             and factual_result is None
         )
-        permutation_idx = len(accuracies) + (not run_factual_guidelines)
+        permutation_idx = len(results) + (not run_factual_guidelines)
 
-        if (
-            run_id is None and len(accuracies) != last_run_count
-        ) or last_run_count == 0:
+        if (run_id is None and len(results) != last_run_count) or last_run_count == 0:
             run_id_ = _get_run_id(
                 model_name,
                 domain,
@@ -372,30 +701,55 @@ def evaluate(
                 n_permutations,
                 permutation_idx,
             )
-            timestr = config_logging(run_id=run_id_, **kwargs)
+            timestr, structured_log = _config_logging(
+                run_id_, structured_log, log_kwargs, thread_log, **kwargs
+            )
         elif run_id:
             run_id_ = run_id
-            timestr = config_logging(run_id=run_id_, **kwargs)
+            timestr, structured_log = _config_logging(
+                run_id_, structured_log, log_kwargs, thread_log, **kwargs
+            )
 
-        last_run_count = len(accuracies)
+        last_run_count = len(results)
 
-        if run_factual_guidelines:
-            label_permutation = get_label_permutation(
-                labels, None, None, shuffle=shuffle_guidelines
-            )
+        with timer.stage("permutation_search", key=run_id_):
+            if run_factual_guidelines:
+                label_permutation = get_label_permutation(
+                    labels, None, None, shuffle=shuffle_guidelines
+                )
 
-        elif label_noise == "random":
-            label_permutation = get_label_permutation(
-                labels,
-                label_noise,
-                random.Random(seed),
-                permutation_idx=idx,
-                shuffle=shuffle_guidelines,
-            )
-        else:
-            label_permutation = get_label_permutation(
-                labels, label_noise, random_, shuffle=shuffle_guidelines
-            )
+            elif planned_permutations is not None:
+                label_permutation = None
+                if idx < len(planned_permutations):
+                    label_permutation = planned_permutations[idx]
+
+            elif label_noise == "random":
+                if n_permutations_per_distance and shuffle_guidelines:
+                    idx = get_next_candidate_idx(
+                        labels,
+                        concept_guidelines["definition"],
+                        idx,
+                        permutation_metric_counts,
+                        n_permutations_per_distance,
+                        seed=seed,
+                        permutation_order=permutation_order,
+                    )
+                label_permutation = get_label_permutation(
+                    labels,
+                    label_noise,
+                    random.Random(seed),
+                    permutation_idx=idx,
+                    shuffle=shuffle_guidelines,
+                    permutation_order=permutation_order,
+                )
+            else:
+                label_permutation = get_label_permutation(
+                    labels,
+                    label_noise,
+                    random_,
+                    shuffle=shuffle_guidelines,
+                    permutation_order=permutation_order,
+                )
 
         if label_permutation is None or len(label_permutation) == 0:
             logger.info(f"No permutations remaining. Exiting loop.")
@@ -403,9 +757,12 @@ def evaluate(
 
         guideline_metrics = None
         if not run_factual_guidelines and label_noise in ["random", "nonfactual"]:
-            permutation_metrics_tmp = add_permutation_metrics(
-                label_permutation, concept_guidelines["definition"], permutation_metrics
-            )
+            with timer.stage("permutation_search", key=run_id_):
+                permutation_metrics_tmp = add_permutation_metrics(
+                    label_permutation,
+                    concept_guidelines["definition"],
+                    permutation_metrics,
+                )
             distance = permutation_metrics_tmp[f"permutation_edit_distance"][-1]
             distance_count = permutation_metric_counts.get(distance, 0)
 
@@ -417,13 +774,12 @@ def evaluate(
             permutation_metrics = permutation_metrics_tmp
             permutation_metric_counts[distance] = distance_count + 1
 
-            if factual_result:
-                factual_prediction_fn = lambda index: factual_result["predictions"][
-                    index
-                ]
+            if factual_result is not None:
+                factual_prediction_fn = partial(_get_factual_prediction, factual_result)
                 guideline_metrics = [
                     dict(
                         metric_fn=guideline_effect,
+                        batch_metric_fn=guideline_effect_batch,
                         metric_kwargs=dict(
                             label_permutation=label_permutation,
                             factual_prediction_fn=factual_prediction_fn,
@@ -440,21 +796,37 @@ def evaluate(
         )
         logger.info(f"Parameters:\n{pformat(param_dict)}")
 
-        context_prompt = get_context_prompt(
-            concept_guidelines,
-            guideline_keys,
-            label_permutation,
-            examples_per_label,
-            label_type,
-            empty_definition,
-            add_task_prompt,
-            add_previous_text,
-            noisy_channel,
-            random_,
-        )
+        with timer.stage("context_prompt", key=run_id_):
+            context_prompt = get_context_prompt(
+                concept_guidelines,
+                guideline_keys,
+                label_permutation,
+                examples_per_label,
+                label_type,
+                empty_definition,
+                add_task_prompt,
+                add_previous_text,
+                noisy_channel,
+                random_,
+            )
         logger.info(f"context_prompt:\n\n{context_prompt}")
 
-        result = evaluate_classifier(
+        checkpoint_key = "factual" if run_factual_guidelines else str(len(results))
+        state = dict(
+            label_permutation=label_permutation,
+            idx=idx,
+            distance_counts=dict(permutation_metric_counts),
+            random_state=random_.getstate(),
+            run_id=run_id_,
+            timestr=timestr,
+        )
+        record = checkpoint.get(checkpoint_key)
+        if record is not None:
+            _check_resumed_state(record, state)
+            logger.info(f"Resuming finished run {record['run_id']}")
+            run_id_, timestr = record["run_id"], record["timestr"]
+
+        classifier_kwargs = dict(
             model_name=model_name,
             model_context_prompt=context_prompt,
             model_labels=labels_,
@@ -468,20 +840,104 @@ def evaluate(
             seed=seed,
             **kwargs,
         )
-        if output_path is None:
-            output_path = result["output_path"]
+        if record is not None:
+            result = record["result"]
+        elif (
+            batch_permutations
+            or classifier
+            or early_stopping
+            or cascade
+            or stratified_bootstrap
+            or streaming
+            or is_fake_model(model_name)
+        ):
+            # filled in by evaluate_classifier_batched after the loop
+            result = {}
+            if run_factual_guidelines:
+                classifier_kwargs["early_stopping"] = False
+            if measure_guideline_effect and not cascade_guideline_effect:
+                # the cheap stage follows the (permuted) definitions of the
+                # prompt by construction, which would inflate guideline effects
+                classifier_kwargs["cascade"] = False
+            batched_jobs.append((classifier_kwargs, result))
+            batched_states.append((checkpoint_key, state, result))
+        elif executor is not None:
+            result = executor.submit(
+                _evaluate_classifier,
+                log_path=_get_log_path(run_id_, timestr, ".txt", **kwargs),
+                **classifier_kwargs,
+            )
+            result.add_done_callback(
+                partial(_save_checkpoint, checkpoint, checkpoint_key, state)
+            )
+            result.add_done_callback(
+                partial(_add_future_timings, timer, run_id_, time.perf_counter())
+            )
+            if run_factual_guidelines:
+                # guideline effects of the permutations need these predictions
+                result = result.result()
+        else:
+            with timer.stage("evaluate_classifier", key=run_id_):
+                result = _evaluate_classifier(**classifier_kwargs)
+            checkpoint.update({checkpoint_key: _get_checkpoint_record(state, result)})
 
         if run_factual_guidelines:
             factual_result = result
             random_ = random.Random(seed)
         else:
-            agg_scores = result["agg_scores"]
-            accuracies.append(
-                agg_scores["classification_metrics"]["exact_match"]["mean"]
-            )
+            results.append(result)
             idx += 1
 
+    if batched_jobs:
+        from engine import evaluate_classifier_batched
+
+        prediction_cache = prediction_cache_path
+        if prediction_cache is None and kwargs.get("use_model_cache"):
+            prediction_cache = PREDICTION_CACHE_PATH
+        evaluate_classifier_batched(
+            batched_jobs,
+            batch_size=permutation_batch_size,
+            max_batch_tokens=max_batch_tokens,
+            classifier=classifier,
+            prediction_cache=prediction_cache,
+            early_stopping=early_stopping,
+            cascade=cascade,
+            stratified_bootstrap=stratified_bootstrap,
+            timer=timer,
+            checkpoint=Checkpoint(
+                checkpoint_dir / "samples.jsonl", resume=bool(resume)
+            ),
+            on_result=partial(_save_batched_checkpoint, checkpoint, batched_states),
+        )
+
+    results = [r.result() if isinstance(r, Future) else r for r in results]
+
+    if results_store:
+        from results_store import append_run, get_condition
+
+        condition = get_condition(label_noise, empty_definition)
+        with timer.stage("results_store"):
+            for result in [factual_result] + results:
+                if result is not None:
+                    append_run(
+                        Path(result["output_path"]).parent,
+                        results_store,
+                        condition=condition,
+                    )
+
+    output_path = None
+    if factual_result:
+        output_path = factual_result["output_path"]
+    elif results:
+        output_path = results[0]["output_path"]
+
+    accuracies = [
+        r["agg_scores"]["classification_metrics"]["exact_match"]["mean"]
+        for r in results
+    ]
     permutation_metrics["accuracy"] = accuracies
+    if early_stopping:
+        permutation_metrics["n_samples"] = [r["n_samples"] for r in results]
     logger.debug(f"Permutation metrics:\n{pformat(permutation_metrics)}")
     permutation_metrics = pd.DataFrame(permutation_metrics)
 
@@ -493,9 +949,20 @@ def evaluate(
             logger.info(f"Correlation with {metric}:\n{corr.loc[metric]}")
         logger.info(f"Permutation metric counts:\n{pformat(permutation_metric_counts)}")
 
-    if output_path:
-        file_path = Path(output_path).parent / "permutation_metrics.csv"
-        permutation_metrics.to_csv(file_path, index=False)
+    output_dir = Path(output_path).parent if output_path else None
+    if output_dir:
+        with timer.stage("save"):
+            permutation_metrics.to_csv(
+                output_dir / "permutation_metrics.csv", index=False
+            )
+    if profiler is not None:
+        profiler.stop(output_dir)
+    if output_dir:
+        timer.save(output_dir / "timings.json")
+    if structured_log is not None:
+        structured_log.close()
+    if thread_log is not None:
+        thread_log.close()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
 import fire
 
 from run import evaluate
+from sweep import run_sweep
 
 
-def _eval_domain(domain, model_name, model_checkpoint_path, model_dtype):
+def _get_domain_config(
+    domain, model_name, model_checkpoint_path, model_dtype, stratified_permutations
+):
 
     kwargs = dict(
         model_name=model_name,
@@ -16,6 +19,7 @@ def _eval_domain(domain, model_name, model_checkpoint_path, model_dtype):
         output_dir="output",
         use_model_cache=True,
         n_permutations_per_distance=10,
+        stratified_permutations=stratified_permutations,
         measure_guideline_effect=True,
         shuffle_guidelines=True,
         label_noise="random",
@@ -41,7 +45,7 @@ def _eval_domain(domain, model_name, model_checkpoint_path, model_dtype):
     if model_dtype:
         kwargs["model_dtype"] = model_dtype
 
-    evaluate(**kwargs)
+    return kwargs
 
 
 def main(
@@ -49,7 +53,17 @@ def main(
     domain=None,
     model_checkpoint_path=None,
     model_dtype=None,
+    stratified_permutations=False,
+    n_workers=1,
+    resume=None,
+    batch_permutations=False,
+    **kwargs,
 ):
+    # Extra flags (e.g. --ignore_errors, --model_request_interval or
+    # --model_requests_per_minute) are passed to every evaluate call.
+    # --batch_permutations runs all permutations of a domain on the batched
+    # engine, whose API client schedules concurrent requests within the rate
+    # limits.
     if domain is None:
         domains = ["financial", "scientific"]
     elif isinstance(domain, str):
@@ -57,8 +71,27 @@ def main(
     else:
         domains = domain
 
-    for domain in domains:
-        _eval_domain(domain, model_name, model_checkpoint_path, model_dtype)
+    configs = [
+        _get_domain_config(
+            domain,
+            model_name,
+            model_checkpoint_path,
+            model_dtype,
+            stratified_permutations,
+        )
+        for domain in domains
+    ]
+    for config in configs:
+        config.update(kwargs, resume=resume)
+        if batch_permutations:
+            config["batch_permutations"] = True
+
+    if n_workers > 1:
+        run_sweep(configs, n_workers)
+        return
+
+    for config in configs:
+        evaluate(**config)
 
 
 if __name__ == "__main__":
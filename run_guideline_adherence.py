@@ -1,37 +1,117 @@
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from glob import glob
+import json
+import os
+from pathlib import Path
 
 import fire
-import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
+import numpy as np
 
+from results_store import load_metrics
+
+EFFECTS_CACHE_PATH = Path(".cache") / "guideline_effects.json"
+EFFECTS = [(1, "positive"), (-1, "negative"), (0, "neutral")]
+
+
+def _read_partial_effects(path):
+    # Mean and effect counts of each guideline_match_* column of one file
+    import pandas as pd
+
+    data = pd.read_csv(path, usecols=lambda col: "guideline_match_" in col)
+    values = data.to_numpy(dtype=float)
+    counts = {str(v): (values == v).sum(axis=0).tolist() for v, _ in EFFECTS}
+    partial = {}
+    for idx, col in enumerate(data.columns):
+        partial[col] = dict(
+            mean=data[col].mean(),
+            counts={v: col_counts[idx] for v, col_counts in counts.items()},
+        )
+    return partial
+
+
+def _load_effects_cache(cache_path):
+    if cache_path and Path(cache_path).exists():
+        with open(cache_path) as f:
+            return json.load(f)
+    return {}
+
+
+def _save_effects_cache(cache, cache_path):
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+
+
+def get_guideline_effects(paths, cache_path=EFFECTS_CACHE_PATH, n_workers=8):
+    # Files are read in parallel and their partial aggregates are cached by
+    # path and modification time, so only new or changed files are read.
+    cache = _load_effects_cache(cache_path)
+    keys = [str(Path(path).resolve()) for path in paths]
+    mtimes = {key: os.stat(key).st_mtime_ns for key in keys}
+    missing = [key for key in keys if cache.get(key, {}).get("mtime") != mtimes[key]]
+    if missing:
+        with ThreadPoolExecutor(n_workers) as executor:
+            partials = executor.map(_read_partial_effects, missing)
+            for key, partial in zip(missing, partials):
+                cache[key] = dict(mtime=mtimes[key], effects=partial)
+        if cache_path:
+            _save_effects_cache(cache, cache_path)
 
-def get_guideline_effects(paths):
     results = {}
-    for path in paths:
-        data = pd.read_csv(path)
-        for col in data.columns:
-            if "guideline_match_" in col:
-                col_data = data[col].dropna()
-                results[f"{col}_avg"] = col_data.mean()
-
-                total_count = 0
-                for val, effect in [(1, "positive"), (-1, "negative"), (0, "neutral")]:
-                    col_count = sum(col_data == val)
-                    count = results.get(f"{col}_{effect}", 0)
-                    count += col_count
-                    results[f"{col}_{effect}"] = count
-                    total_count += count
-
-                for effect in ["positive", "negative", "neutral"]:
-                    count = results[f"{col}_{effect}"]
-                    results[f"{col}_{effect}_norm"] = count / total_count
+    counts = {}
+    for key in keys:
+        for col, partial in cache[key]["effects"].items():
+            if col not in counts:
+                counts[col] = {effect: 0 for _, effect in EFFECTS}
+                # same key order as when counts were normalized per file
+                results[f"{col}_avg"] = None
+                results.update({f"{col}_{effect}": 0 for _, effect in EFFECTS})
+                results.update({f"{col}_{e}_norm": None for _, e in EFFECTS})
+            # like before, the average is the one of the last file
+            results[f"{col}_avg"] = partial["mean"]
+            for val, effect in EFFECTS:
+                counts[col][effect] += partial["counts"][str(val)]
 
+    for col, col_counts in counts.items():
+        total_count = sum(col_counts.values())
+        for effect, count in col_counts.items():
+            results[f"{col}_{effect}"] = count
+            results[f"{col}_{effect}_norm"] = (
+                count / total_count if total_count else np.nan
+            )
     return results
 
 
-def plot_effects(paths, domain, effect="positive"):
-    guideline_effects = get_guideline_effects(paths)
+def get_store_guideline_effects(store_path, run_pattern, domain=None):
+    # Same effects as get_guideline_effects, from a single scan of the
+    # results store (see results_store.py)
+    filters = [("domain", "=", domain)] if domain else None
+    metrics = load_metrics(
+        store_path,
+        columns=["run", "metric", "value"],
+        filters=filters,
+        metric_prefix="guideline_match_",
+    )
+    runs = [run for run in metrics["run"].unique() if fnmatch(run, run_pattern)]
+    metrics = metrics[metrics["run"].isin(runs)]
+
+    results = {}
+    for col, col_data in metrics.groupby("metric", sort=False)["value"]:
+        results[f"{col}_avg"] = col_data.mean()
+        counts = {}
+        for val, effect in [(1, "positive"), (-1, "negative"), (0, "neutral")]:
+            counts[effect] = (col_data == val).sum()
+            results[f"{col}_{effect}"] = counts[effect]
+        for effect, count in counts.items():
+            results[f"{col}_{effect}_norm"] = count / sum(counts.values())
+    return results
+
+
+def plot_effects(guideline_effects, domain, effect="positive"):
     effects = []
     for key in sorted(guideline_effects):
         if f"{effect}_norm" in key:
@@ -47,6 +127,11 @@ def plot_effects(paths, domain, effect="positive"):
                 }
             )
 
+    # plotting libraries are only loaded when a plot is drawn
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sns
+
     df = pd.DataFrame(effects)
     df = df.pivot(index="concept_a", columns="concept_b", values="accuracy")
     # specify size of heatmap
@@ -62,7 +147,7 @@ def plot_effects(paths, domain, effect="positive"):
     return df
 
 
-def main():
+def main(results_store=None):
     metric_paths = {
         "financial_llama2": "data/results/financial/reports_sample_eacl_20231013*llama-2-7b-chat-financial*/*metrics_per_sample.csv",
         "financial_gpt": "data/results/financial/reports_sample_eacl_20231013*gpt-3.5-*-financial*/*metrics_per_sample.csv",
@@ -71,8 +156,15 @@ def main():
     }
 
     for domain_model, metric_path in metric_paths.items():
-        paths = glob(metric_path)
-        _ = plot_effects(paths, domain_model)
+        if results_store:
+            guideline_effects = get_store_guideline_effects(
+                results_store,
+                Path(metric_path).parent.name,
+                domain=domain_model.split("_")[0],
+            )
+        else:
+            guideline_effects = get_guideline_effects(glob(metric_path))
+        _ = plot_effects(guideline_effects, domain_model)
 
 
 if __name__ == "__main__":
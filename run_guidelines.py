@@ -1,10 +1,11 @@
 import fire
 
 from run import evaluate
+from sweep import run_sweep
 
 
-def _eval_domain(domain, model_name, model_checkpoint_path, model_dtype):
-
+def _get_domain_configs(domain, model_name, model_checkpoint_path, model_dtype):
+    configs = []
     for label_noise in ["factual", "nonfactual", "empty_def", "ood", "ood_empty_def"]:
         kwargs = dict(
             model_name=model_name,
@@ -40,7 +41,8 @@ def _eval_domain(domain, model_name, model_checkpoint_path, model_dtype):
         if model_dtype:
             kwargs["model_dtype"] = model_dtype
 
-        evaluate(**kwargs)
+        configs.append(kwargs)
+    return configs
 
 
 def main(
@@ -48,7 +50,16 @@ def main(
     domain=None,
     model_checkpoint_path=None,
     model_dtype=None,
+    n_workers=1,
+    resume=None,
+    keep_model_loaded=False,
+    batch_permutations=False,
+    **kwargs,
 ):
+    # Extra flags (e.g. --ignore_errors, --model_request_interval or
+    # --model_requests_per_minute) are passed to every evaluate call.
+    # --batch_permutations runs each condition on the batched engine, whose
+    # API client schedules concurrent requests within the rate limits.
     if domain is None:
         domains = ["financial", "scientific"]
     elif isinstance(domain, str):
@@ -56,8 +67,41 @@ def main(
     else:
         domains = domain
 
+    configs = []
     for domain in domains:
-        _eval_domain(domain, model_name, model_checkpoint_path, model_dtype)
+        configs.extend(
+            _get_domain_configs(domain, model_name, model_checkpoint_path, model_dtype)
+        )
+
+    for config in configs:
+        config.update(kwargs, resume=resume)
+        if batch_permutations:
+            config["batch_permutations"] = True
+
+    if keep_model_loaded and n_workers > 1:
+        raise ValueError("keep_model_loaded shares one model and needs n_workers=1")
+
+    if n_workers > 1:
+        run_sweep(configs, n_workers)
+        return
+
+    if not keep_model_loaded:
+        for config in configs:
+            evaluate(**config)
+        return
+
+    # the model is loaded once and shared by all conditions and domains, which
+    # runs them on the batched engine instead of llms' evaluate_classifier
+    from engine import ModelSession, get_model_kwargs
+
+    with ModelSession(
+        model_name,
+        ignore_errors=configs[0].get("ignore_errors", False),
+        seed=configs[0].get("seed", 17),
+        **get_model_kwargs(configs[0]),
+    ) as session:
+        for config in configs:
+            evaluate(classifier=session.classifier, **config)
 
 
 if __name__ == "__main__":
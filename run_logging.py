@@ -0,0 +1,195 @@
+import atexit
+import gzip
+import hashlib
+import importlib.util
+import json
+import logging
+import logging.handlers
+import os
+from pathlib import Path
+import queue
+import shutil
+import threading
+
+# per-sample records of llms (model input, prompts and outputs)
+SAMPLED_LOGGERS = ("llms.models.base",)
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+_RECORD_KEYS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # one JSON object per record, with any `extra` fields of the record
+    def format(self, record):
+        data = dict(
+            time=record.created,
+            level=record.levelname,
+            logger=record.name,
+            message=record.getMessage(),
+        )
+        data.update({k: v for k, v in vars(record).items() if k not in _RECORD_KEYS})
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class SampleFilter(logging.Filter):
+    # Keeps the first `first_n` records of each kind (logger and message
+    # prefix) from `loggers`, then a `rate` fraction of them. Records of the
+    # same sample, e.g. its prompt and its output, are kept together.
+    def __init__(self, loggers=SAMPLED_LOGGERS, rate=0.01, first_n=5):
+        super().__init__()
+        self.loggers = tuple(loggers)
+        self.rate = rate
+        self.first_n = first_n
+        self.counts = {}
+
+    def filter(self, record):
+        if not record.name.startswith(self.loggers):
+            return True
+        kind = (record.name, str(record.msg).split(":", 1)[0])
+        count = self.counts.get(kind, 0)
+        self.counts[kind] = count + 1
+        if count < self.first_n:
+            return True
+        return int((count + 1) * self.rate) > int(count * self.rate)
+
+
+class BlobFilter(logging.Filter):
+    # Messages longer than `min_size` (e.g. the context prompt) are logged in
+    # full once; repeats are replaced by their first line and hash
+    def __init__(self, min_size=1000):
+        super().__init__()
+        self.min_size = min_size
+        self.hashes = set()
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) < self.min_size:
+            return True
+        blob_hash = hashlib.sha256(message.encode()).hexdigest()[:16]
+        record.blob_hash = blob_hash
+        if blob_hash in self.hashes:
+            first_line = message.split("\n", 1)[0][:200]
+            record.msg = f"{first_line} [logged before, sha256: {blob_hash}]"
+            record.args = None
+        self.hashes.add(blob_hash)
+        return True
+
+
+class ThreadFilter(logging.Filter):
+    # Records logged by the thread that created the filter, e.g. one config of
+    # a sweep, whose threads share the root logger
+    def __init__(self):
+        super().__init__()
+        self.thread_id = threading.get_ident()
+
+    def filter(self, record):
+        return record.thread == self.thread_id
+
+
+class ThreadLog:
+    # Text log of the current thread's records, in the format of llms'
+    # per-run logs. open() moves it to the log file of the next run.
+    def __init__(self, level=logging.INFO):
+        self.level = level
+        self.handler = None
+
+    def open(self, path):
+        self.close()
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.handler = logging.FileHandler(path)
+        self.handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self.handler.setLevel(self.level)
+        self.handler.addFilter(ThreadFilter())
+        root = logging.getLogger()
+        if root.level > self.level:
+            root.setLevel(self.level)
+        root.addHandler(self.handler)
+
+    def close(self):
+        if self.handler is not None:
+            logging.getLogger().removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
+
+
+def compress_log(path, compression="gzip"):
+    path = Path(path)
+    compressed_path = path.with_name(path.name + COMPRESSIONS[compression])
+    if compression == "zstd":
+        import zstandard
+
+        with open(path, "rb") as f, open(compressed_path, "wb") as f_out:
+            zstandard.ZstdCompressor().copy_stream(f, f_out)
+    else:
+        with open(path, "rb") as f, gzip.open(compressed_path, "wb") as f_out:
+            shutil.copyfileobj(f, f_out)
+    os.remove(path)
+    return compressed_path
+
+
+class StructuredLog:
+    # JSON lines log of a sweep. Records are filtered in the logging thread
+    # and formatted and written by a background queue listener, so that the
+    # inference loop does not wait for disk I/O. The file is compressed when
+    # the log is closed.
+    def __init__(
+        self,
+        path,
+        sample_rate=0.01,
+        sample_first_n=5,
+        sampled_loggers=SAMPLED_LOGGERS,
+        min_blob_size=1000,
+        compression="auto",
+        level=logging.INFO,
+        thread_only=False,
+    ):
+        if compression == "auto":
+            has_zstd = importlib.util.find_spec("zstandard") is not None
+            compression = "zstd" if has_zstd else "gzip"
+        if compression and compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unsupported log compression: {compression}."
+                f" Options: {['auto'] + list(COMPRESSIONS)}"
+            )
+        if compression == "zstd" and importlib.util.find_spec("zstandard") is None:
+            # fail before the run rather than when the log is closed
+            raise ValueError("zstd log compression needs the zstandard package")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.compression = compression
+
+        file_handler = logging.FileHandler(self.path)
+        file_handler.setFormatter(JsonLinesFormatter())
+        self.handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        self.handler.setLevel(level)
+        self.handler.addFilter(
+            SampleFilter(sampled_loggers, sample_rate, sample_first_n)
+        )
+        self.handler.addFilter(BlobFilter(min_blob_size))
+        if thread_only:
+            self.handler.addFilter(ThreadFilter())
+        self.listener = logging.handlers.QueueListener(self.handler.queue, file_handler)
+        self._file_handler = file_handler
+
+        root = logging.getLogger()
+        if root.level > level:
+            root.setLevel(level)
+        root.addHandler(self.handler)
+        self.listener.start()
+        self._closed = False
+        # records of a crashed run are still written
+        atexit.register(self.close)
+
+    def close(self):
+        if self._closed:
+            return None
+        self._closed = True
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        self._file_handler.close()
+        if self.compression:
+            return compress_log(self.path, self.compression)
+        return self.path
@@ -0,0 +1,388 @@
+import json
+import logging
+import random
+import time
+
+import fire
+import numpy as np
+
+from backends import parse_prediction
+from run import GUIDELINES, _get_run_id, get_balanced_indices, get_context_prompt
+
+logger = logging.getLogger(__name__)
+
+JOINT_LABEL_TYPE = "Answer"
+
+
+def get_field_name(concept):
+    return concept.replace("_", " ").capitalize()
+
+
+def _get_labels(concept_guidelines):
+    labels = concept_guidelines.get("labels")
+    if labels is None:
+        labels = sorted(concept_guidelines["definition"].keys())
+    if isinstance(labels, list):
+        labels = {l: l for l in labels}
+    return labels
+
+
+def get_joint_context_prompt(
+    domain_guidelines, concepts, guideline_keys, examples_per_label, seed=17
+):
+    # One section per concept with its categories (and examples), followed by
+    # instructions for a structured answer with one line per concept
+    sections = ["Annotate the text below with each of the following concepts."]
+    fields = {}
+    for concept in concepts:
+        concept_guidelines = domain_guidelines[concept]
+        labels = _get_labels(concept_guidelines)
+        field = get_field_name(concept)
+        fields[field] = labels
+        section = get_context_prompt(
+            concept_guidelines,
+            guideline_keys,
+            {l: l for l in labels},
+            examples_per_label,
+            field,
+            empty_definition=False,
+            add_task_prompt=False,
+            add_previous_text=False,
+            noisy_channel=False,
+            random_=random.Random(seed),
+        )
+        sections.append(f"{field} categories:\n\n{section}")
+
+    answer_format = "\n".join(f"{field}: <category>" for field in fields)
+    sections.append(
+        "For each concept, classify the text below into one of its categories."
+        " Be concise and answer with one line per concept, in this format:"
+        f"\n{answer_format}"
+    )
+    return "\n\n".join(sections), fields
+
+
+def parse_joint_output(output, fields):
+    # Per-concept predictions from a "Concept: category" line per concept or
+    # from a JSON object; missing concepts are predicted as ""
+    if output is None:
+        return {field: "" for field in fields}
+    if isinstance(output, str):
+        try:
+            output = json.loads(output)
+        except ValueError:
+            pass
+
+    values = {}
+    if isinstance(output, dict):
+        values = {str(k).strip().lower(): str(v) for k, v in output.items()}
+    else:
+        for line in str(output).split("\n"):
+            key, sep, value = line.partition(":")
+            key = key.strip(" -*#`'\"").lower()
+            if sep and key not in values:
+                values[key] = value.strip()
+
+    predictions = {}
+    for field, labels in fields.items():
+        value = values.get(field.lower())
+        predictions[field] = "" if value is None else parse_prediction(value, labels)
+    return predictions
+
+
+def load_samples(
+    dataset_name,
+    source_key,
+    target_keys,
+    balanced=False,
+    max_samples=None,
+    shuffle=False,
+    seed=17,
+):
+    # Same samples as a single-concept run balanced on the first concept (see
+    # engine.load_samples), with the references of every concept. Concepts
+    # without a column in the dataset have no references.
+    from engine import read_dataset
+
+    data = read_dataset(dataset_name)
+    first_key = next(iter(target_keys.values()))
+    idxs = np.arange(len(data))
+    if balanced:
+        idxs = get_balanced_indices(
+            data[first_key], max_samples=max_samples, random_state=seed, logger=logger
+        )
+    if shuffle:
+        logger.info(f"Shuffling data using seed: {seed}")
+        order = list(range(len(idxs)))
+        random.Random(seed).shuffle(order)
+        idxs = idxs[order]
+    if max_samples:
+        idxs = idxs[:max_samples]
+
+    sources = data[source_key].iloc[idxs].tolist()
+    references = {}
+    for concept, target_key in target_keys.items():
+        if target_key in data:
+            references[concept] = data[target_key].iloc[idxs].tolist()
+        else:
+            logger.warning(f"No references for {concept}: missing {target_key}")
+            references[concept] = None
+    return sources, references
+
+
+def _is_reference(value):
+    return value is not None and str(value) != "nan"
+
+
+def _save_concept_result(predictions, references, sources, job_kwargs, seed=17):
+    # Per-concept results layout of run.evaluate. Samples without a reference
+    # are left out of the metrics.
+    import pandas as pd
+
+    from engine import (
+        _get_per_sample_metrics,
+        _get_file_prefix,
+        get_output_dir,
+        save_result,
+    )
+    from metrics import aggregate_metrics
+
+    if references is None:
+        output_dir = get_output_dir(
+            job_kwargs["output_dir"],
+            job_kwargs["dataset_name"],
+            job_kwargs["timestr"],
+            job_kwargs["run_id"],
+        )
+        output_dir.mkdir(parents=True, exist_ok=True)
+        predictions_path = output_dir / (
+            f"{_get_file_prefix(job_kwargs['model_name'])}_predictions.csv"
+        )
+        pd.DataFrame(dict(prediction=predictions)).to_csv(predictions_path, index=False)
+        return dict(output_path=str(predictions_path))
+
+    idxs = [idx for idx, r in enumerate(references) if _is_reference(r)]
+    result = dict(
+        predictions=[predictions[idx] for idx in idxs],
+        references=[references[idx] for idx in idxs],
+    )
+    per_sample_metrics = _get_per_sample_metrics(
+        result["predictions"],
+        result["references"],
+        [sources[idx] for idx in idxs],
+    )
+    result["agg_scores"] = aggregate_metrics(per_sample_metrics, seed=seed)
+    save_result(result, job_kwargs, per_sample_metrics)
+    return result
+
+
+def _get_usage(classifier, outputs, lengths, wall):
+    generated = [o for o in outputs if isinstance(o, str) and o]
+    generated_tokens = sum(classifier.count_tokens(generated)) if generated else 0
+    return dict(
+        calls=len(outputs),
+        prompt_tokens=int(np.sum(lengths)),
+        generated_tokens=int(generated_tokens),
+        wall=wall,
+    )
+
+
+def _get_accuracy(result):
+    if result.get("agg_scores") is None:
+        return None
+    return result["agg_scores"]["classification_metrics"]["exact_match"]
+
+
+def evaluate_multi_concept(
+    concepts=("capital", "sentiment", "content"),
+    domain="financial",
+    guidelines=("definition",),
+    examples_per_label=1,
+    label_type=None,
+    target_keys=None,
+    compare_single=True,
+    balanced=False,
+    max_samples=None,
+    shuffle=False,
+    batch_size=8,
+    max_batch_tokens=None,
+    prediction_cache_path=None,
+    output_dir="output",
+    classifier=None,
+    model_name=None,
+    dataset_name=None,
+    source_key="text",
+    seed=17,
+    **kwargs,
+):
+    # Classifies every sample for several concepts of a domain with a single
+    # prompt and model call, and writes the results of each concept like
+    # run.evaluate (condition "joint"). With `compare_single`, the concepts
+    # are also evaluated one at a time on the same samples, to compare
+    # accuracy and token usage of both modes.
+    from engine import ModelSession, get_item_outputs, get_model_kwargs, get_output_dir
+    from prediction_cache import PredictionCache
+
+    concepts = list(concepts)
+    guideline_keys = list(guidelines)
+    domain_guidelines = GUIDELINES[domain]
+    if label_type is None:
+        label_type = f"{domain} concept".capitalize()
+    target_keys = {c: (target_keys or {}).get(c, c) for c in concepts}
+
+    sources, references = load_samples(
+        dataset_name,
+        source_key,
+        target_keys,
+        balanced=balanced,
+        max_samples=max_samples,
+        shuffle=shuffle,
+        seed=seed,
+    )
+    context_prompt, fields = get_joint_context_prompt(
+        domain_guidelines, concepts, guideline_keys, examples_per_label, seed
+    )
+    logger.info(f"context_prompt:\n\n{context_prompt}")
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+
+    session = None
+    if classifier is None:
+        session = ModelSession(model_name, seed=seed, **get_model_kwargs(kwargs))
+        classifier = session.classifier
+    if getattr(classifier, "label_scoring", False) or getattr(
+        classifier, "constrained_decoding", False
+    ):
+        raise ValueError(
+            "Joint classification needs free-form outputs: disable label_scoring"
+            " and constrained_decoding."
+        )
+    prediction_cache = None
+    if prediction_cache_path:
+        prediction_cache = PredictionCache(prediction_cache_path)
+
+    def run_items(items):
+        start = time.perf_counter()
+        outputs, lengths = get_item_outputs(
+            classifier,
+            items,
+            batch_size=batch_size,
+            max_batch_tokens=max_batch_tokens,
+            prediction_cache=prediction_cache,
+        )
+        usage = _get_usage(classifier, outputs, lengths, time.perf_counter() - start)
+        return outputs, usage
+
+    logger.info(
+        f"Evaluating {model_name} on {len(sources)} samples"
+        f" x {len(concepts)} concepts with a joint prompt."
+    )
+    joint_items = [
+        dict(
+            context_prompt=context_prompt,
+            input=source,
+            labels=list(fields),
+            label_type=JOINT_LABEL_TYPE,
+            fields=fields,
+        )
+        for source in sources
+    ]
+    joint_outputs, joint_usage = run_items(joint_items)
+    joint_predictions = [parse_joint_output(o, fields) for o in joint_outputs]
+
+    job_kwargs = dict(
+        model_name=model_name,
+        dataset_name=dataset_name,
+        output_dir=output_dir,
+        timestr=timestr,
+    )
+    summary = dict(concepts={}, joint=joint_usage)
+    single_usage = []
+    for concept, field in zip(concepts, fields):
+        predictions = [p[field] for p in joint_predictions]
+        run_id = _get_run_id(model_name, domain, concept, guideline_keys, "joint", 1, 0)
+        result = _save_concept_result(
+            predictions,
+            references[concept],
+            sources,
+            dict(job_kwargs, run_id=run_id),
+            seed=seed,
+        )
+        concept_summary = dict(joint_accuracy=_get_accuracy(result))
+
+        if compare_single:
+            concept_guidelines = domain_guidelines[concept]
+            labels = _get_labels(concept_guidelines)
+            # same context prompt as run.evaluate without label noise
+            single_prompt = get_context_prompt(
+                concept_guidelines,
+                guideline_keys,
+                {l: l for l in labels},
+                examples_per_label,
+                label_type,
+                empty_definition=False,
+                add_task_prompt=True,
+                add_previous_text=False,
+                noisy_channel=False,
+                random_=random.Random(seed),
+            )
+            items = [
+                dict(
+                    context_prompt=single_prompt,
+                    input=source,
+                    labels=labels,
+                    label_type=label_type,
+                )
+                for source in sources
+            ]
+            outputs, usage = run_items(items)
+            single_usage.append(usage)
+            single_predictions = [
+                parse_prediction(o, labels) if o is not None else "" for o in outputs
+            ]
+            run_id = _get_run_id(
+                model_name, domain, concept, guideline_keys, None, 1, 0
+            )
+            result = _save_concept_result(
+                single_predictions,
+                references[concept],
+                sources,
+                dict(job_kwargs, run_id=run_id),
+                seed=seed,
+            )
+            concept_summary["single_accuracy"] = _get_accuracy(result)
+            concept_summary["agreement"] = float(
+                np.mean([a == b for a, b in zip(predictions, single_predictions)])
+            )
+        summary["concepts"][concept] = concept_summary
+        logger.info(f"Results of {concept}: {concept_summary}")
+
+    if single_usage:
+        summary["single"] = {
+            k: sum(usage[k] for usage in single_usage) for k in single_usage[0]
+        }
+        summary["savings"] = {
+            k: 1 - joint_usage[k] / summary["single"][k]
+            for k in ["calls", "prompt_tokens", "generated_tokens", "wall"]
+            if summary["single"][k]
+        }
+
+    if prediction_cache is not None:
+        prediction_cache.report()
+        prediction_cache.close()
+    if session is not None:
+        session.close()
+
+    summary_dir = get_output_dir(
+        output_dir, dataset_name, timestr, f"{model_name}-{domain}-joint"
+    )
+    summary_dir.mkdir(parents=True, exist_ok=True)
+    summary_path = summary_dir / "multi_concept_metrics.json"
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    logger.info(f"Multi-concept metrics saved to {summary_path}")
+    return summary
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    fire.Fire(evaluate_multi_concept)
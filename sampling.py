@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+import random
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+SAMPLES_CACHE_DIR = Path(".cache") / "samples"
+
+_SAMPLES_CACHE = {}
+
+
+def iter_chunks(dataset_name, columns, chunksize=10000):
+    suffix = Path(dataset_name).suffix
+    if suffix == ".jsonl":
+        reader = pd.read_json(dataset_name, lines=True, chunksize=chunksize)
+    elif suffix == ".json":
+        # plain JSON documents cannot be read incrementally
+        yield pd.read_json(dataset_name)[columns]
+        return
+    else:
+        reader = pd.read_csv(dataset_name, usecols=columns, chunksize=chunksize)
+
+    offset = 0
+    with reader:
+        for chunk in reader:
+            chunk = chunk[columns]
+            chunk.index = range(offset, offset + len(chunk))
+            offset += len(chunk)
+            yield chunk
+
+
+def _get_class_seed(seed, target):
+    digest = hashlib.sha256(f"{seed}-{target}".encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def reservoir_sample_balanced(chunks, source_key, target_key, max_samples, seed=17):
+    # One pass over the data with a seeded reservoir per class: every row gets
+    # a random key and each class keeps the rows with the smallest keys, which
+    # is a uniform sample in random order. With `max_samples`, a reservoir
+    # never holds more than `max_samples` rows, so memory does not grow with
+    # the corpus size.
+    reservoirs = {}
+    counts = {}
+    randoms = {}
+    for chunk in chunks:
+        targets = chunk[target_key]
+        chunk = chunk[targets.notna() & (targets.astype(str) != "nan")]
+        for target, group in chunk.groupby(target_key, sort=False):
+            if target not in reservoirs:
+                reservoirs[target] = (np.empty(0), [])
+                counts[target] = 0
+                randoms[target] = np.random.default_rng(_get_class_seed(seed, target))
+            counts[target] += len(group)
+            keys, sources = reservoirs[target]
+            keys = np.concatenate([keys, randoms[target].random(len(group))])
+            sources = sources + group[source_key].tolist()
+            if max_samples and len(keys) > max_samples:
+                keep = np.argpartition(keys, max_samples)[:max_samples]
+                keys, sources = keys[keep], [sources[idx] for idx in keep]
+            reservoirs[target] = keys, sources
+
+    if not reservoirs:
+        return [], []
+    if max_samples:
+        max_per_class = max_samples // len(reservoirs)
+    else:
+        max_per_class = min(counts.values())
+    logger.info(
+        f"Sampled balanced data for {len(reservoirs)} classes"
+        f" (maximum of {max_per_class} samples per class; seed={seed})"
+    )
+
+    sources, targets = [], []
+    for target in sorted(reservoirs):
+        keys, class_sources = reservoirs[target]
+        order = np.argsort(keys, kind="stable")[:max_per_class]
+        sources.extend(class_sources[idx] for idx in order)
+        targets.extend([target] * len(order))
+    return sources, targets
+
+
+def _select_rows(dataset_name, source_key, target_key, max_samples, shuffle, seed):
+    # Without balancing, rows are picked by index: the shuffled order needs
+    # only the row count, and reading stops once all selected rows are found.
+    columns = [source_key, target_key]
+    if shuffle:
+        n_rows = sum(len(c) for c in iter_chunks(dataset_name, [target_key]))
+        idxs = list(range(n_rows))
+        random.Random(seed).shuffle(idxs)
+    else:
+        idxs = None
+
+    if max_samples:
+        if idxs is None:
+            idxs = range(max_samples)
+        idxs = idxs[:max_samples]
+
+    rows = {}
+    selected = None if idxs is None else set(idxs)
+    for chunk in iter_chunks(dataset_name, columns):
+        if selected is not None:
+            chunk = chunk[chunk.index.isin(selected)]
+        for idx, source, target in zip(
+            chunk.index, chunk[source_key], chunk[target_key]
+        ):
+            rows[idx] = (source, target)
+        if selected is not None and len(rows) == len(selected):
+            break
+
+    if idxs is None:
+        idxs = sorted(rows)
+    idxs = [idx for idx in idxs if idx in rows]
+    return [rows[idx][0] for idx in idxs], [rows[idx][1] for idx in idxs]
+
+
+def _get_cache_key(dataset_name, **params):
+    stat = Path(dataset_name).stat()
+    params = dict(
+        params,
+        dataset_name=str(Path(dataset_name).resolve()),
+        mtime=stat.st_mtime_ns,
+        size=stat.st_size,
+    )
+    params = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+def load_samples_streaming(
+    dataset_name,
+    source_key,
+    target_key,
+    max_samples=None,
+    shuffle=False,
+    balanced=False,
+    seed=17,
+    cache_dir=SAMPLES_CACHE_DIR,
+):
+    # Reads CSV/JSONL datasets in chunks, keeping only the selected samples.
+    # The selection is cached in memory and on disk, so that later runs of a
+    # sweep over the same data do not read the dataset again.
+    key = _get_cache_key(
+        dataset_name,
+        source_key=source_key,
+        target_key=target_key,
+        max_samples=max_samples,
+        shuffle=shuffle,
+        balanced=balanced,
+        seed=seed,
+    )
+    cache_path = Path(cache_dir) / f"{key}.json" if cache_dir else None
+    if key in _SAMPLES_CACHE:
+        return _SAMPLES_CACHE[key]
+    if cache_path and cache_path.exists():
+        with open(cache_path) as f:
+            samples = json.load(f)
+        logger.info(f"Loaded {len(samples['sources'])} samples from {cache_path}")
+        _SAMPLES_CACHE[key] = samples["sources"], samples["targets"]
+        return _SAMPLES_CACHE[key]
+
+    if balanced:
+        chunks = iter_chunks(dataset_name, [source_key, target_key])
+        sources, targets = reservoir_sample_balanced(
+            chunks, source_key, target_key, max_samples, seed=seed
+        )
+        if shuffle:
+            idxs = list(range(len(sources)))
+            random.Random(seed).shuffle(idxs)
+            sources = [sources[idx] for idx in idxs]
+            targets = [targets[idx] for idx in idxs]
+        if max_samples:
+            sources, targets = sources[:max_samples], targets[:max_samples]
+    else:
+        sources, targets = _select_rows(
+            dataset_name, source_key, target_key, max_samples, shuffle, seed
+        )
+    logger.info(f"Selected {len(sources)} samples from {dataset_name}")
+
+    if cache_path:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(dict(sources=sources, targets=targets), f, default=str)
+    _SAMPLES_CACHE[key] = sources, targets
+    return sources, targets
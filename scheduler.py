@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = None
+
+    def reset_lock(self):
+        # asyncio locks are bound to the first event loop that waits on them
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        if self._lock is None:
+            self.reset_lock()
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                elapsed = now - self.updated_at
+                self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RequestScheduler:
+    # Runs blocking `request_fn(payload)` calls concurrently, within request
+    # and token rate limits, retrying RetryableError with jittered exponential
+    # backoff. With `ignore_errors`, failed requests return None.
+    def __init__(
+        self,
+        request_fn,
+        max_concurrency=8,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_retries=6,
+        backoff_base=1.0,
+        backoff_max=60.0,
+        ignore_errors=False,
+        seed=17,
+    ):
+        self.request_fn = request_fn
+        self.max_concurrency = max_concurrency
+        self.request_bucket = None
+        self.token_bucket = None
+        if requests_per_minute:
+            self.request_bucket = TokenBucket(requests_per_minute)
+        if tokens_per_minute:
+            self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.ignore_errors = ignore_errors
+        self.random_ = random.Random(seed)
+        self.stats = dict(requests=0, retries=0, errors=0)
+
+    def _get_backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        max_backoff = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return self.random_.uniform(0, max_backoff)
+
+    async def _run_request(self, payload, n_tokens, semaphore):
+        for attempt in range(self.max_retries + 1):
+            if self.request_bucket:
+                await self.request_bucket.acquire()
+            if self.token_bucket:
+                await self.token_bucket.acquire(n_tokens)
+
+            async with semaphore:
+                self.stats["requests"] += 1
+                try:
+                    return await asyncio.to_thread(self.request_fn, payload)
+                except RetryableError as err:
+                    if attempt == self.max_retries:
+                        error = err
+                        break
+                    backoff = self._get_backoff(attempt, err.retry_after)
+                    logger.warning(f"{err} Retrying in {backoff:.1f}s...")
+                    self.stats["retries"] += 1
+                except Exception as err:
+                    error = err
+                    break
+            await asyncio.sleep(backoff)
+
+        self.stats["errors"] += 1
+        if self.ignore_errors:
+            logger.error(f"Request failed: {error}")
+            return None
+        raise error
+
+    async def run_async(self, payloads, n_tokens=None):
+        if n_tokens is None:
+            n_tokens = [1] * len(payloads)
+        # run() starts a new event loop on each call
+        for bucket in [self.request_bucket, self.token_bucket]:
+            if bucket:
+                bucket.reset_lock()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        tasks = [
+            self._run_request(payload, tokens, semaphore)
+            for payload, tokens in zip(payloads, n_tokens)
+        ]
+        return await asyncio.gather(*tasks)
+
+    def run(self, payloads, n_tokens=None):
+        start = time.monotonic()
+        outputs = asyncio.run(self.run_async(payloads, n_tokens=n_tokens))
+        elapsed = time.monotonic() - start
+        logger.info(
+            f"Processed {len(payloads)} requests in {elapsed:.1f}s"
+            f" ({len(payloads) / max(elapsed, 1e-9):.2f} requests/s): {self.stats}"
+        )
+        return outputs
@@ -0,0 +1,26 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import logging
+import multiprocessing
+
+from run import evaluate
+
+logger = logging.getLogger(__name__)
+
+
+def run_sweep(configs, n_workers=None):
+    # Runs several `evaluate` configs (e.g. domains x label noise conditions)
+    # on a shared pool of worker processes. Each config is driven by a thread
+    # that plans its label permutations in order and submits one job per
+    # permutation, so prompts and outputs match a sequential run. The factual
+    # baseline of a config is awaited before its permutations are submitted.
+    n_workers = n_workers or multiprocessing.cpu_count()
+    logger.info(f"Running {len(configs)} configs on {n_workers} workers")
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(n_workers, mp_context=context) as executor:
+        with ThreadPoolExecutor(len(configs)) as threads:
+            futures = [
+                threads.submit(evaluate, executor=executor, **kwargs)
+                for kwargs in configs
+            ]
+            for future in futures:
+                future.result()
@@ -0,0 +1,63 @@
+from pathlib import Path
+import sys
+
+import pytest
+
+# the modules of this project are top-level scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+TOKENIZER_TEXTS = [
+    "Classify the text below into one of the following categories.",
+    "- Human: skills, training and experience of employees.",
+    "- Financial: funds obtained through financing or generated by operations.",
+    "Text: the company reported strong growth in revenue\nConcept: Financial",
+    "Text: our employees completed safety training\nConcept: Human",
+]
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    # A randomly initialized Llama model with a SentencePiece-style tokenizer:
+    # "▁" is prepended to the start of the text only, so a prompt suffix
+    # tokenized on its own starts with other tokens than inside the prompt
+    pytest.importorskip("torch")
+    tokenizers = pytest.importorskip("tokenizers")
+    transformers = pytest.importorskip("transformers")
+    from tokenizers import Regex, decoders, models, pre_tokenizers, trainers
+
+    tokenizer = tokenizers.Tokenizer(models.BPE(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence(
+        [
+            pre_tokenizers.Split(Regex("\n"), behavior="isolated"),
+            pre_tokenizers.Metaspace(replacement="▁", prepend_scheme="first"),
+        ]
+    )
+    tokenizer.decoder = decoders.Metaspace(replacement="▁", prepend_scheme="first")
+    trainer = trainers.BpeTrainer(
+        vocab_size=400, special_tokens=["<unk>", "<s>", "</s>"]
+    )
+    tokenizer.train_from_iterator(TOKENIZER_TEXTS * 20, trainer)
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        unk_token="<unk>",
+        bos_token="<s>",
+        eos_token="</s>",
+    )
+
+    import torch
+
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    path = tmp_path_factory.mktemp("tiny_llama")
+    tokenizer.save_pretrained(path)
+    transformers.LlamaForCausalLM(config).save_pretrained(path)
+    return str(path)
@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from engine import _get_baseline_samples, _get_cascade_stats
+from test_checkpoints import N_JOBS, _evaluate
+
+
+def test_baseline_samples_are_shared_by_jobs():
+    job_samples = [list(range(10)), [0, 2, 4, 6, 8]]
+    baseline_samples = _get_baseline_samples(job_samples, 4, seed=17)
+    assert len(baseline_samples[0]) == 4
+    assert set(baseline_samples[1]) <= set(job_samples[1])
+    # the second job stopped early: its subset is the first job's subset
+    # among the samples it evaluated, filled up with the next ones
+    assert set(baseline_samples[0]) & set(job_samples[1]) <= set(baseline_samples[1])
+
+
+def test_cascade_stats_compare_with_all_llm_predictions():
+    result = dict(predictions=["a", "b", "a", "b"], references=["a", "a", "a", "b"])
+    stages = ["cheap", "cheap", "llm", "llm"]
+    # the LLM gets both cheap-stage samples right
+    baseline = ([[0, 1, 2]], [["a", "a", "a"]], 2, 1.0)
+    (stats,) = _get_cascade_stats(
+        [({}, result)], [list(range(4))], stages, 4, 0.5, 1.0, baseline
+    )
+    assert stats["cheap"] == dict(n_samples=2, accuracy=0.5)
+    assert stats["llm"] == dict(n_samples=2, accuracy=1.0)
+    assert stats["all_llm"]["accuracy"] == 1.0
+    assert stats["all_llm"]["cascade_accuracy"] == 2 / 3
+    assert stats["all_llm"]["accuracy_delta"] == 2 / 3 - 1
+    # 4 LLM samples in 2 seconds
+    assert stats["throughput"]["llm_samples_per_second"] == 2.0
+
+
+@pytest.mark.parametrize("cascade_guideline_effect", [False, True])
+def test_cascade_skips_guideline_effect_runs(
+    tmp_path, monkeypatch, cascade_guideline_effect
+):
+    monkeypatch.chdir(Path(__file__).resolve().parents[1])
+    # every sample is confident enough for the cheap stage
+    _evaluate(
+        tmp_path,
+        cascade_threshold=0.1,
+        cascade_guideline_effect=cascade_guideline_effect,
+    )
+    paths = sorted(tmp_path.glob("*/fake_predictions.csv"))
+    assert len(paths) == N_JOBS
+    for path in paths:
+        stages = set(pd.read_csv(path)["stage"])
+        assert stages == ({"cheap"} if cascade_guideline_effect else {"llm"})
+        # TF-IDF probabilities are not saved as model label scores
+        assert not (path.parent / "fake_label_scores.csv").exists()
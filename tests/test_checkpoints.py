@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+import backends
+import engine
+from run import evaluate
+
+N_SAMPLES = 60
+# the factual baseline and 3 permutations
+N_JOBS = 4
+
+
+def _evaluate(output_dir, **kwargs):
+    return evaluate(
+        concept="capital",
+        domain="financial",
+        guidelines=["definition"],
+        label_noise="random",
+        n_permutations=N_JOBS - 1,
+        measure_guideline_effect=True,
+        shuffle_guidelines=True,
+        balanced=True,
+        model_name="fake",
+        dataset_name="data/financial_reports.csv",
+        target_key="capital",
+        label_type="concept",
+        max_samples=N_SAMPLES,
+        shuffle=True,
+        output_dir=str(output_dir),
+        log_format="jsonl",
+        log_compression=None,
+        **kwargs,
+    )
+
+
+def _read_records(output_dir, name):
+    (path,) = output_dir.glob(f"checkpoints/*/{name}")
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+@pytest.fixture
+def concurrent_classifier(monkeypatch):
+    # a fake API classifier that fails on the `fail_at`-th call
+    calls = []
+    get_outputs = backends.FakeClassifier.get_outputs
+
+    def _get_outputs(self, items):
+        calls.append(len(items))
+        if len(calls) == concurrent_classifier.fail_at:
+            raise RuntimeError("API is down")
+        return get_outputs(self, items)
+
+    monkeypatch.chdir(engine.Path(__file__).resolve().parents[1])
+    monkeypatch.setattr(engine, "CONCURRENT_BATCH_SIZE", 50)
+    monkeypatch.setattr(backends.FakeClassifier, "concurrent", True, raising=False)
+    monkeypatch.setattr(backends.FakeClassifier, "get_outputs", _get_outputs)
+    concurrent_classifier.fail_at = None
+    concurrent_classifier.calls = calls
+    return concurrent_classifier
+
+
+def test_concurrent_classifier_progress_is_checkpointed(
+    concurrent_classifier, tmp_path
+):
+    concurrent_classifier.fail_at = 3
+    with pytest.raises(RuntimeError, match="API is down"):
+        _evaluate(tmp_path)
+    # the first two batches of requests were saved before the failure
+    assert len(_read_records(tmp_path, "samples.jsonl")) == 2 * 50
+
+    concurrent_classifier.fail_at = None
+    concurrent_classifier.calls.clear()
+    _evaluate(tmp_path, resume=tmp_path)
+    assert sum(concurrent_classifier.calls) == N_JOBS * N_SAMPLES - 2 * 50
+
+
+def test_batched_results_are_checkpointed_per_permutation(
+    concurrent_classifier, tmp_path, monkeypatch
+):
+    saved = []
+    save_result = engine.save_result
+
+    def _save_result(*args):
+        if len(saved) == 2:
+            raise RuntimeError("disk full")
+        saved.append(args)
+        return save_result(*args)
+
+    monkeypatch.setattr(engine, "save_result", _save_result)
+    with pytest.raises(RuntimeError, match="disk full"):
+        _evaluate(tmp_path)
+    assert len(_read_records(tmp_path, "permutations.jsonl")) == 2
@@ -0,0 +1,7 @@
+from benchmarks import IMPORT_TIME_BUDGET, check_import_times
+
+
+def test_entry_points_import_quickly():
+    # the entry points load models, pandas and plotting libraries lazily;
+    # raises if one of them is over budget or imports a heavy module
+    check_import_times(budget=IMPORT_TIME_BUDGET)
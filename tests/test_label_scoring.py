@@ -0,0 +1,81 @@
+import pytest
+
+from backends import HFClassifier
+from test_prefix_cache import CONTEXT_PROMPT, INPUTS
+
+torch = pytest.importorskip("torch")
+
+LABELS = ["Human", "Financial"]
+
+
+@pytest.fixture(scope="module")
+def classifier(tiny_model_path):
+    return HFClassifier(
+        "tiny", checkpoint_path=tiny_model_path, device="cpu", label_scoring=True
+    )
+
+
+def _get_item(text, noisy_channel=False):
+    return dict(
+        context_prompt=CONTEXT_PROMPT,
+        input=text,
+        labels=LABELS,
+        label_type="Concept",
+        noisy_channel=noisy_channel,
+    )
+
+
+def _score_full_prompt(classifier, condition_text, scored_text):
+    # log-likelihood of the tokens added by `scored_text`, with one forward
+    # pass on the full prompt
+    condition_ids = classifier._encode(condition_text)
+    input_ids = classifier._encode(condition_text + scored_text)
+    n_shared = 0
+    while (
+        n_shared < len(condition_ids) and input_ids[n_shared] == condition_ids[n_shared]
+    ):
+        n_shared += 1
+    with torch.no_grad():
+        logits = classifier.model(input_ids=torch.tensor([input_ids])).logits[0]
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    return sum(
+        log_probs[idx - 1, input_ids[idx]].item()
+        for idx in range(n_shared, len(input_ids))
+    )
+
+
+@pytest.mark.parametrize("prefix_cache", [False, True])
+@pytest.mark.parametrize("noisy_channel", [False, True])
+def test_label_scores_match_full_prompt_scoring(
+    classifier, monkeypatch, prefix_cache, noisy_channel
+):
+    monkeypatch.setattr(classifier, "prefix_cache", prefix_cache)
+    monkeypatch.setattr(classifier, "_prefix_caches", {})
+    items = [_get_item(text, noisy_channel) for text in INPUTS]
+    label_scores = classifier.score_labels(items)
+
+    for item, scores in zip(items, label_scores):
+        prefix, continuations = classifier._get_label_candidates(item)
+        expected = torch.softmax(
+            torch.tensor(
+                [
+                    _score_full_prompt(classifier, prefix + condition, scored)
+                    for condition, scored in continuations
+                ]
+            ),
+            dim=0,
+        ).tolist()
+        assert list(scores) == LABELS
+        assert list(scores.values()) == pytest.approx(expected, abs=1e-4)
+
+
+def test_label_continuations_are_tokenized_in_the_full_prompt(classifier):
+    # the case the full-prompt tokenization guards against: the scored text
+    # tokenized on its own is not the end of the full prompt's tokens
+    prefix, continuations = classifier._get_label_candidates(_get_item(INPUTS[0]))
+    condition, scored = continuations[0]
+    full_ids = classifier._encode(prefix + condition + scored)
+    assert (
+        classifier._encode(condition) + classifier._encode(scored)
+        != full_ids[len(classifier._encode(prefix)) :]
+    )
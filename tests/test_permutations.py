@@ -0,0 +1,27 @@
+import itertools
+import random
+
+import pytest
+
+from permutations import SHUFFLE_MAX_ITEMS, get_shuffled_permutation
+
+
+@pytest.mark.parametrize("n_items", [4, SHUFFLE_MAX_ITEMS + 1])
+def test_default_order_replays_the_shuffle_of_all_permutations(n_items):
+    # the order used before permutations were unranked, also above the
+    # size where the "auto" order switches to the feistel order
+    items = [f"label {ii}" for ii in range(n_items)]
+    for seed, permutation_idx in [(17, 0), (17, 5), (3, 1000)]:
+        expected_random = random.Random(seed)
+        permutations = list(itertools.permutations(items))
+        if permutation_idx < len(permutations):
+            expected_random.shuffle(permutations)
+
+        random_ = random.Random(seed)
+        permutation = get_shuffled_permutation(items, random_, permutation_idx)
+        if permutation_idx < len(permutations):
+            assert permutation == list(permutations[permutation_idx])
+        else:
+            assert permutation is None
+        # later draws of the generator are unchanged too
+        assert random_.random() == expected_random.random()
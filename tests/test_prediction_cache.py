@@ -0,0 +1,38 @@
+import pytest
+
+from backends import HFClassifier
+from engine import _get_cache_keys
+from prediction_cache import PredictionCache
+
+ITEMS = [
+    dict(context_prompt="Classify the text.", input="text", labels=["a", "b"]),
+]
+
+
+@pytest.mark.parametrize("dtype", [None, "float32"])
+def test_cache_keys_depend_on_dtype(tiny_model_path, dtype):
+    items = [dict(item, label_type="Concept") for item in ITEMS]
+    keys = {}
+    for model_dtype in [dtype, "bfloat16"]:
+        classifier = HFClassifier(
+            "tiny", checkpoint_path=tiny_model_path, dtype=model_dtype, device="cpu"
+        )
+        keys[model_dtype] = _get_cache_keys(classifier, items)
+        classifier.close()
+    assert keys[dtype] != keys["bfloat16"]
+    assert classifier.generation_kwargs["dtype"] == "torch.bfloat16"
+    assert classifier.generation_kwargs["device"] == "cpu"
+
+
+def test_cache_evicts_while_inserting(tmp_path):
+    cache = PredictionCache(tmp_path / "cache.sqlite", max_size_mb=0.01, evict_every=10)
+    value = "x" * 500
+    for idx in range(100):
+        cache.set_many({f"key {idx}": value})
+        size = cache.connection.execute("SELECT SUM(size) FROM predictions").fetchone()
+        # at most `evict_every` inserts over the size limit
+        assert size[0] <= cache.max_size + 10 * (len(value) + 10)
+    assert cache.stats["evicted"] > 0
+    # the most recent entries are kept
+    assert cache.get_many(["key 99"]) == {"key 99": value}
+    cache.connection.close()
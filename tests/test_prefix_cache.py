@@ -0,0 +1,89 @@
+import pytest
+
+from backends import HFClassifier
+
+CONTEXT_PROMPT = (
+    "Classify the text below into one of the following categories.\n\n"
+    "- Human: skills, training and experience of employees.\n"
+    "- Financial: funds obtained through financing or generated by operations."
+)
+INPUTS = [
+    "the company reported strong growth in revenue",
+    "our employees completed safety training",
+    "funds obtained through financing",
+]
+
+
+@pytest.fixture(scope="module")
+def classifier(tiny_model_path):
+    return HFClassifier(
+        "tiny", checkpoint_path=tiny_model_path, device="cpu", max_new_tokens=8
+    )
+
+
+def _get_items(labels=("Human", "Financial")):
+    return [
+        dict(
+            context_prompt=CONTEXT_PROMPT,
+            input=text,
+            labels=list(labels),
+            label_type="Concept",
+        )
+        for text in INPUTS
+    ]
+
+
+def test_suffix_is_tokenized_as_in_the_full_prompt(classifier):
+    prefix, suffix = classifier.split_prompt(_get_items()[0])
+    suffix_ids = classifier._get_suffix_ids(prefix, suffix)
+    prompt_ids = classifier._encode(prefix + suffix)
+    assert classifier._encode(prefix) + suffix_ids == prompt_ids
+    # the case the split guards against
+    assert classifier._encode(suffix) != suffix_ids
+
+
+@pytest.mark.parametrize("constrained_decoding", [False, True])
+def test_prefix_cache_matches_uncached_generation(classifier, constrained_decoding):
+    items = _get_items()
+    tries = None
+    if constrained_decoding:
+        tries = [classifier.get_label_trie(item["labels"]) for item in items]
+
+    uncached = [
+        classifier.generate(
+            [classifier.build_prompt(item)], tries=tries and [tries[idx]]
+        )[0]
+        for idx, item in enumerate(items)
+    ]
+    classifier.prefix_cache = True
+    classifier._prefix_caches = {}
+    try:
+        prompts = [classifier.split_prompt(item) for item in items]
+        cached = classifier.generate_with_prefix_cache(prompts, tries=tries)
+        assert classifier.prefix_cache, "prefix cache check failed"
+    finally:
+        classifier.prefix_cache = False
+    assert cached == uncached
+
+
+def test_prefix_cache_decodes_the_full_prompt_tokens(classifier, monkeypatch):
+    decoded = []
+    greedy_decode_batch = classifier._greedy_decode_batch
+
+    def _greedy_decode_batch(prefix, suffixes, tries=None):
+        decoded.append((prefix, [list(x) for x in suffixes]))
+        return greedy_decode_batch(prefix, suffixes, tries=tries)
+
+    monkeypatch.setattr(classifier, "_greedy_decode_batch", _greedy_decode_batch)
+    monkeypatch.setattr(classifier, "prefix_cache", True)
+    monkeypatch.setattr(classifier, "_prefix_caches", {})
+    prompts = [classifier.split_prompt(item) for item in _get_items()]
+    classifier.generate_with_prefix_cache(prompts)
+
+    # one batch for the shared prefix
+    assert len(decoded) == 1
+    prefix, suffixes = decoded[0]
+    prefix_ids = classifier._get_prefix_cache(prefix)[0]
+    assert len(suffixes) == len(prompts)
+    for (_, suffix), suffix_ids in zip(prompts, suffixes):
+        assert list(prefix_ids) + suffix_ids == classifier._encode(prefix + suffix)
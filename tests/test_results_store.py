@@ -0,0 +1,29 @@
+from pathlib import Path
+
+import pytest
+
+from results_store import get_condition, load_predictions
+from test_checkpoints import N_JOBS, N_SAMPLES, _evaluate
+
+pytest.importorskip("pyarrow")
+
+
+def test_conditions_match_run_guidelines():
+    assert get_condition() == "factual"
+    assert get_condition("ood") == "ood"
+    assert get_condition(empty_definition=True) == "empty_def"
+    assert get_condition("ood", empty_definition=True) == "ood_empty_def"
+
+
+@pytest.mark.parametrize("empty_definition", [False, True])
+def test_runs_are_stored_under_their_condition(tmp_path, monkeypatch, empty_definition):
+    monkeypatch.chdir(Path(__file__).resolve().parents[1])
+    store_path = tmp_path / "results"
+    _evaluate(
+        tmp_path / "runs", empty_definition=empty_definition, results_store=store_path
+    )
+    predictions = load_predictions(store_path, columns=["run", "condition"])
+    assert len(predictions) == N_JOBS * N_SAMPLES
+    # the run directory names do not tell empty definitions apart
+    expected = "random_empty_def" if empty_definition else "random"
+    assert set(predictions["condition"]) == {expected}
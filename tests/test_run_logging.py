@@ -0,0 +1,33 @@
+import gzip
+import importlib.util
+import json
+import logging
+
+import pytest
+
+from run_logging import StructuredLog
+
+HAS_ZSTD = importlib.util.find_spec("zstandard") is not None
+
+
+def test_structured_log_auto_compression(tmp_path):
+    log = StructuredLog(tmp_path / "run_log.jsonl", sample_rate=1)
+    logging.getLogger("run").info("Processing label permutation 1 of 3")
+    path = log.close()
+    assert path.suffix == (".zst" if HAS_ZSTD else ".gz")
+    if not HAS_ZSTD:
+        with gzip.open(path, "rt") as f:
+            records = [json.loads(line) for line in f]
+        assert records[-1]["message"] == "Processing label permutation 1 of 3"
+
+
+@pytest.mark.skipif(HAS_ZSTD, reason="zstandard is installed")
+def test_structured_log_zstd_needs_zstandard(tmp_path):
+    with pytest.raises(ValueError, match="zstandard"):
+        StructuredLog(tmp_path / "run_log.jsonl", compression="zstd")
+    assert not (tmp_path / "run_log.jsonl").exists()
+
+
+def test_structured_log_unsupported_compression(tmp_path):
+    with pytest.raises(ValueError, match="Unsupported log compression"):
+        StructuredLog(tmp_path / "run_log.jsonl", compression="bz2")
@@ -0,0 +1,102 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+
+import pytest
+
+from backends import OpenAIClassifier
+from scheduler import TokenBucket
+
+LATENCY = 0.05
+RETRY_AFTER = 0.1
+
+
+class StubServer(ThreadingHTTPServer):
+    # Chat completions endpoint that rate limits the first request of each
+    # prompt with a 429 and answers the others after some latency
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.active = 0
+        self.max_active = 0
+        self.n_requests = 0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = payload["messages"][0]["content"]
+        with server.lock:
+            server.n_requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            is_limited = (server.n_run, prompt) not in server.seen
+            server.seen.add((server.n_run, prompt))
+        try:
+            if is_limited:
+                self.send_response(429)
+                self.send_header("Retry-After", str(RETRY_AFTER))
+                self.end_headers()
+                return
+            time.sleep(LATENCY)
+            body = json.dumps(
+                dict(choices=[dict(message=dict(content=prompt.split("\n")[0]))])
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    server.n_run = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_scheduler_retries_rate_limits_across_runs(server):
+    max_concurrency = 4
+    classifier = OpenAIClassifier(
+        "stub",
+        api_key="test",
+        base_url=f"http://127.0.0.1:{server.server_port}/v1",
+        max_tokens=4,
+        max_concurrency=max_concurrency,
+        tokens_per_minute=600,
+        timeout=5,
+    )
+    # a small burst so that requests queue on the token bucket
+    classifier.scheduler.token_bucket = TokenBucket(6000, capacity=40)
+    items = [
+        dict(context_prompt="", input=f"sample {ii}", labels=[], label_type="Label")
+        for ii in range(8)
+    ]
+
+    # run() starts a new event loop each time, with the same buckets
+    for n_run in range(2):
+        server.n_run = n_run
+        outputs = classifier.get_outputs(items)
+        assert outputs == [f"Text: sample {ii}" for ii in range(8)]
+
+    stats = classifier.scheduler.stats
+    assert stats["retries"] == 2 * len(items)
+    assert stats["errors"] == 0
+    assert stats["requests"] == server.n_requests == 4 * len(items)
+    assert server.max_active <= max_concurrency
@@ -0,0 +1,128 @@
+from contextlib import contextmanager
+import cProfile
+import json
+import logging
+import os
+from pathlib import Path
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def get_peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak_rss / 2**20
+    return peak_rss / 2**10
+
+
+class StageTimer:
+    # Wall and CPU time of named stages, with counters such as samples and
+    # tokens. Stages timed for a permutation are keyed by its run id, the
+    # others are shared by the whole sweep. CPU time is process-wide, so it
+    # includes other threads running at the same time.
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, key=None, **counts):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.add(
+                name,
+                key=key,
+                wall=time.perf_counter() - wall,
+                cpu=time.process_time() - cpu,
+                calls=1,
+                **counts,
+            )
+
+    def add(self, name, key=None, **values):
+        with self._lock:
+            stage = self.stages.setdefault(key, {}).setdefault(name, {})
+            for k, v in values.items():
+                stage[k] = stage.get(k, 0) + v
+
+    def _get_stats(self, stages):
+        stats = {}
+        for name, values in stages.items():
+            values = dict(values)
+            wall = values.get("wall", 0)
+            for count in ["samples", "prompt_tokens", "generated_tokens"]:
+                if count in values and wall > 0:
+                    values[f"{count}_per_second"] = values[count] / wall
+            stats[name] = values
+        return stats
+
+    def to_dict(self):
+        with self._lock:
+            stages = {k: dict(v) for k, v in self.stages.items()}
+        return dict(
+            sweep=self._get_stats(stages.pop(None, {})),
+            permutations={k: self._get_stats(v) for k, v in stages.items()},
+            peak_rss_mb=get_peak_rss_mb(),
+        )
+
+    def save(self, path):
+        timings = self.to_dict()
+        with open(path, "w") as f:
+            json.dump(timings, f, indent=2)
+        sweep = {k: round(v["wall"], 2) for k, v in timings["sweep"].items()}
+        logger.info(f"Stage timings (s): {sweep}. Timings saved to {path}")
+
+
+PROFILERS = ["cprofile", "py-spy"]
+
+
+class Profiler:
+    # Optional profile of a whole run: "cprofile" writes pstats data (e.g.
+    # for snakeviz), "py-spy" attaches py-spy to this process and writes a
+    # speedscope profile, which also covers native code
+    def __init__(self, kind="cprofile"):
+        if kind is True:
+            kind = "cprofile"
+        if kind not in PROFILERS:
+            raise ValueError(f"Unsupported profiler: {kind}. Options: {PROFILERS}")
+        self.kind = kind
+        self._profile = None
+        self._process = None
+        self._path = None
+
+    def start(self, tmp_dir):
+        if self.kind == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            return
+        self._path = Path(tmp_dir) / "profile.speedscope.json"
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        command = ["py-spy", "record", "--pid", str(os.getpid())]
+        command += ["--format", "speedscope", "--output", str(self._path)]
+        self._process = subprocess.Popen(command)
+
+    def stop(self, output_dir=None):
+        if self.kind == "cprofile":
+            self._profile.disable()
+            if output_dir is None:
+                return None
+            path = Path(output_dir) / "profile.prof"
+            self._profile.dump_stats(path)
+        else:
+            # py-spy writes the profile when interrupted
+            self._process.send_signal(signal.SIGINT)
+            self._process.wait()
+            if output_dir is None or not self._path.exists():
+                return None
+            path = Path(output_dir) / self._path.name
+            shutil.move(self._path, path)
+        logger.info(f"Profile saved to {path}")
+        return path